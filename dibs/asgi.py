@@ -0,0 +1,308 @@
+'''
+asgi.py: optional asyncio-based server for the DIBS /iiif endpoint
+
+See the docstring of application(...) for how to use it.
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import asyncio
+from   http.cookies import CookieError, SimpleCookie
+import httpx
+from   sidetrack import log
+from   time import monotonic
+
+from .data_models import database, set_read_only, Item, Loan
+from .date_utils import time_now
+from .network import async_hedged, async_session
+from .people import GuestPerson
+from .server import dibs, _IIIF_BASE_URL, _IIIF_BACKENDS, _IIIF_CACHE, _IIIF_FAILURES
+from .server import _IIIF_HEDGE, _IIIF_HEDGE_PERCENTILE, _IIIF_LATENCY, _IIIF_PREFETCH
+from .server import _DATABASE_READ_ONLY_GET, _IIIF_TRANSCODE, _LOAN_TOKENS
+from .server import content_etag, encoded_etag, encoded_iiif_content, etag_matches
+from .server import iiif_error_status, image_request_parts, loan_cookie_name
+from .server import preferred_encoding
+from .server import preferred_image_type, prefetch_iiif_content, record_request
+from .server import transcoded_iiif_content, upstream_ctype, upstream_status
+from .server import upstream_succeeded
+from .server import rewritten_json, urls_restored, user, validator_headers
+from .settings import config
+
+
+# Internal constants and variables.
+# .............................................................................
+
+# Name of the header in which the web server passes the authenticated user.
+_USER_HEADER = config('ASGI_USER_HEADER', default = 'X-Remote-User').lower()
+
+# Loads from the IIIF server in progress in this process.  Keys are URLs and
+# values are asyncio tasks.  (This is only accessed from the event loop.)
+_LOADING = {}
+
+
+# Exported functions.
+# .............................................................................
+
+async def application(scope, receive, send):
+    '''ASGI application serving the DIBS /iiif endpoint.
+
+    This does the same loan checks as the Bottle route, and uses the same IIIF
+    cache, but it can have thousands of requests to the IIIF server in flight
+    in a single process.  Run it with an ASGI server such as Uvicorn, e.g.,
+
+        uvicorn --host 127.0.0.1 --port 8081 dibs.asgi:application
+
+    and configure the web server to send requests for /iiif/ there.  The web
+    server must pass the authenticated user in the header named by the
+    setting ASGI_USER_HEADER (default: X-Remote-User), e.g., in Apache using
+
+        RequestHeader set X-Remote-User "%{REMOTE_USER}s"
+
+    The ASGI server must only be reachable through the web server, because
+    it trusts that header.  Requests for any other path get a 404.
+    '''
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+               for name, value in scope['headers']}
+    path = scope['path']
+    root = scope.get('root_path', '')
+    if root and path.startswith(root):
+        path = path[len(root):]
+    parts = path.split('/', 3)
+    if len(parts) != 4 or parts[1] != 'iiif' or not parts[2] or not parts[3]:
+        await _respond(send, 404)
+        return
+    if scope['method'] not in ['GET', 'HEAD']:
+        await _respond(send, 405, {'Allow': 'GET, HEAD'})
+        return
+
+    _set_base_url(scope, headers)
+    status, response_headers, body = await iiif_response(scope, parts[2], parts[3], headers)
+    if scope['method'] == 'HEAD':
+        # Tell the client the length of the content it would get with GET.
+        response_headers = dict(response_headers, **{'Content-Length': str(len(body))})
+        body = b''
+    await _respond(send, status, response_headers, body)
+
+
+async def iiif_response(scope, barcode, rest, headers):
+    '''Return (status, headers, body) for a request for /iiif/barcode/rest.'''
+    loop = asyncio.get_running_loop()
+    person = GuestPerson(uname = headers.get(_USER_HEADER, ''))
+    if not person.uname:
+        log(f'no user given in {_USER_HEADER} for /iiif/{barcode}/{rest}')
+        return _redirect(scope, f'{dibs.base_url}/notallowed')
+    if loan_token_valid(barcode, person.uname, headers.get('cookie', '')):
+        state = 'active'
+    else:
+        # Database access blocks, so it's done in the thread pool.
+        state = await loop.run_in_executor(None, loan_state, barcode, person.uname)
+    if state is None:
+        log(f'there is no item with barcode {barcode}')
+        return 404, {}, b''
+    if state != 'active':
+        log(f'{user(person)} does not have {barcode} loaned out')
+        return _redirect(scope, f'{dibs.base_url}/notallowed')
+
+    record_request(barcode)
+    url = _IIIF_BASE_URL + '/' + urls_restored(rest, barcode)
+    result = await iiif_content(url, barcode)
+    if _IIIF_PREFETCH:
+        loop.run_in_executor(None, prefetch_iiif_content, url, barcode, person)
+    if not result:
+        return (*iiif_error_status(url), b'')
+    content, ctype = result
+    environ = {'HTTP_ACCEPT_ENCODING': headers.get('accept-encoding', ''),
+               'HTTP_ACCEPT': headers.get('accept', '')}
+    encoding = preferred_encoding(content, ctype, environ)
+    response_headers = {}
+    if ctype == 'application/json':
+        response_headers['Vary'] = 'Accept-Encoding'
+    if _IIIF_TRANSCODE and ctype == 'image/jpeg':
+        response_headers['Vary'] = 'Accept'
+    new_type = preferred_image_type(ctype, environ)
+    if new_type:
+        # Converting images takes a while, so it's done in the thread pool.
+        content, ctype = await loop.run_in_executor(
+            None, transcoded_iiif_content, url, barcode, content, new_type)
+    response_headers['Content-Type'] = ctype
+    if encoding:
+        content = await loop.run_in_executor(
+            None, encoded_iiif_content, url, barcode, content, encoding)
+        response_headers['Content-Encoding'] = encoding
+        etag = encoded_etag(content_etag(content), encoding)
+    else:
+        etag = content_etag(content)
+    response_headers.update(validator_headers(etag))
+    if etag_matches(headers.get('if-none-match', ''), etag):
+        log('client has a current copy; returning 304')
+        response_headers.pop('Content-Type')
+        response_headers.pop('Content-Encoding', None)
+        return 304, response_headers, b''
+    log(f'returning content of /iiif/{barcode}/{rest} for {user(person)}')
+    return 200, response_headers, content
+
+
+def loan_state(barcode, uname):
+    '''Return the state of uname's loan of barcode, '' if none, None if no item.'''
+    # Threads in the pool keep their connections open, as in the Bottle app.
+    if database.connect(reuse_if_open = True) and _DATABASE_READ_ONLY_GET:
+        set_read_only(True)
+    item = Item.get_or_none(Item.barcode == barcode)
+    if not item:
+        return None
+    loan = Loan.get_or_none(Loan.item == item, Loan.user == uname)
+    if not loan:
+        return ''
+    # The Bottle server updates the states of loans that have ended, but
+    # that may not have happened yet.
+    if loan.state == 'active' and loan.end_time <= time_now():
+        return 'recent'
+    return loan.state
+
+
+def loan_token_valid(barcode, uname, cookie_header):
+    '''Return True if the cookies include a valid loan token for barcode.'''
+    if not _LOAN_TOKENS:
+        return False
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header)
+    except CookieError:
+        return False
+    token = cookies.get(loan_cookie_name(barcode))
+    return bool(token) and _LOAN_TOKENS.verify(token.value, uname, barcode)
+
+
+async def iiif_content(url, barcode):
+    '''Return (content, ctype) for url, from the cache or the IIIF server.'''
+    value = _IIIF_CACHE.get(url, barcode, memory_only = True)
+    if value is not None:
+        return value
+    if url in _IIIF_FAILURES:
+        # Don't go back to the IIIF server yet, but use a cached copy if any.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _IIIF_CACHE.get, url, barcode)
+    # Concurrent requests for the same url result in only one upstream fetch.
+    # The fetch is shielded from cancellation, so that a client giving up
+    # does not affect other clients waiting for the same content.
+    task = _LOADING.get(url)
+    if task is None:
+        task = _LOADING[url] = asyncio.ensure_future(_load(url, barcode))
+    return await asyncio.shield(task)
+
+
+async def fetched_iiif_content(url, barcode):
+    '''Get the content at url from the IIIF server & return (content, ctype).'''
+    log(f'getting {url} from server')
+    response, error = await hedged_upstream_get(url)
+    if error or response.status_code != 200:
+        log(f'error {str(error or response.status_code)} accessing {url}')
+        _IIIF_FAILURES[url] = upstream_status(response, error)
+        return None
+    if url.endswith('json'):
+        content = rewritten_json(url, response.text, barcode)
+        ctype = 'application/json'
+    else:
+        content = response.content
+        ctype = upstream_ctype(response, content)
+    return content, ctype
+
+
+async def hedged_upstream_get(url):
+    '''Asynchronous version of server.hedged_upstream_get(...).'''
+    if not _IIIF_HEDGE or not image_request_parts(url):
+        return await upstream_get(url)
+    delay = _IIIF_LATENCY.percentile(_IIIF_HEDGE_PERCENTILE)
+    return await async_hedged(lambda: upstream_get(url), delay, upstream_succeeded)
+
+
+async def upstream_get(url):
+    '''Asynchronous version of server.upstream_get(...), without streaming.'''
+    tried = []
+    while True:
+        base = _IIIF_BACKENDS.choose(exclude = tried)
+        if tried:
+            log(f'retrying {url} using {base}')
+        tried.append(base)
+        response, error = None, None
+        start = monotonic()
+        _IIIF_BACKENDS.started(base)
+        try:
+            response = await async_session().get(_IIIF_BACKENDS.url_for(url, base))
+        except httpx.HTTPError as ex:
+            error = ex
+        except asyncio.CancelledError:
+            # This was the slower of two hedged requests.
+            _IIIF_BACKENDS.cancelled(base)
+            raise
+        ok = upstream_succeeded((response, error))
+        elapsed = monotonic() - start
+        _IIIF_BACKENDS.finished(base, elapsed, ok)
+        if ok and _IIIF_HEDGE and image_request_parts(url):
+            _IIIF_LATENCY.add(elapsed)
+        if ok or len(tried) == len(_IIIF_BACKENDS.urls):
+            return response, error
+
+
+# Internal utilities.
+# .............................................................................
+
+async def _load(url, barcode):
+    loop = asyncio.get_running_loop()
+    try:
+        # The disk cache may block, so it's accessed in the thread pool.
+        value = await loop.run_in_executor(None, _IIIF_CACHE.get, url, barcode)
+        if value is None:
+            value = await fetched_iiif_content(url, barcode)
+            if value is not None:
+                await loop.run_in_executor(None, _IIIF_CACHE.put, url, *value, barcode)
+        return value
+    finally:
+        del _LOADING[url]
+
+
+def _set_base_url(scope, headers):
+    # Same as what adapter.wsgi does for the Bottle application.
+    if not hasattr(dibs, 'base_url'):
+        scheme = scope.get('scheme', 'http')
+        host = headers.get('host')
+        if not host:
+            server = scope.get('server') or ('localhost', 80)
+            host = f'{server[0]}:{server[1]}'
+        dibs.base_url = f'{scheme}://{host}{scope.get("root_path", "")}'
+        log(f'dibs.base_url = {dibs.base_url}')
+
+
+def _redirect(scope, url):
+    # Do what Bottle's redirect(...) does.
+    status = 303 if scope.get('http_version') == '1.1' else 302
+    return status, {'Location': url}, b''
+
+
+async def _respond(send, status, headers = None, body = b''):
+    headers = dict({'Content-Length': str(len(body))}, **(headers or {}))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers.items()]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_session().aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,654 @@
+'''
+caches.py: caches used by the DIBS server for IIIF content
+
+Each server process has a cache in memory, optionally backed by a cache on
+disk that is shared by all the processes and survives restarts.
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import OrderedDict
+from   contextlib import contextmanager
+import fcntl
+from   hashlib import sha256
+import os
+from   os.path import join, exists
+from   sidetrack import log
+import sqlite3
+import threading
+import time
+
+from .compression import compressed
+
+
+# Exported classes.
+# .............................................................................
+
+class DiskCache():
+    '''Content-addressed cache of byte strings, stored in a directory.
+
+    The cache can be used concurrently by multiple threads and processes.
+    Each thread gets its own connection to the SQLite index, and SQLite's own
+    locking coordinates writers across processes.  The "max_bytes" parameter
+    sets the budget for the total size of the content stored; when it is
+    exceeded, entries are removed until the total is back under the limit.
+    Entries can be associated with the barcode of an item, and the entries of
+    an item can be marked idle using demote(barcode).  Idle entries are
+    evicted first, and otherwise the least-recently used entries are evicted.
+    '''
+
+    # Access times are only updated when they're older than this many seconds.
+    # This avoids turning every cache hit into a database write.
+    _ATIME_RESOLUTION = 60
+
+    # Number of entries to remove at a time when evicting entries.
+    _EVICTION_BATCH = 100
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index_file = join(cache_dir, 'index.db')
+        self._local = threading.local()
+        os.makedirs(cache_dir, exist_ok = True)
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entry (key TEXT PRIMARY KEY,'
+                       ' digest TEXT, ctype TEXT, size INTEGER, atime REAL,'
+                       ' barcode TEXT, idle INTEGER DEFAULT 0, stored REAL DEFAULT 0)')
+            # Caches created by earlier versions lack some of the columns.
+            columns = [row[1] for row in db.execute('PRAGMA table_info(entry)')]
+            if 'barcode' not in columns:
+                db.execute('ALTER TABLE entry ADD COLUMN barcode TEXT')
+                db.execute('ALTER TABLE entry ADD COLUMN idle INTEGER DEFAULT 0')
+            if 'stored' not in columns:
+                db.execute('ALTER TABLE entry ADD COLUMN stored REAL DEFAULT 0')
+            db.execute('DROP INDEX IF EXISTS entry_atime')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_eviction ON entry (idle, atime)')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_digest ON entry (digest)')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_barcode ON entry (barcode)')
+            db.execute('CREATE TABLE IF NOT EXISTS usage (bytes INTEGER)')
+            if db.execute('SELECT COUNT(*) FROM usage').fetchone()[0] == 0:
+                db.execute('INSERT INTO usage VALUES (0)')
+        log(f'using disk cache in {cache_dir} with a limit of {max_bytes} bytes')
+
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+
+    def get(self, key):
+        '''Return (content, ctype) for "key", or None if it's not cached.'''
+        found = self.entry(key)
+        return found[:2] if found else None
+
+
+    def entry(self, key):
+        '''Return (content, ctype, stored) for "key", or None if not cached.
+
+        The value of "stored" is the time (as returned by time.time()) when
+        the content was stored.
+        '''
+        found = self._lookup(key)
+        if not found:
+            return None
+        digest, ctype, atime, stored = found
+        try:
+            with open(self._blob_path(digest), 'rb') as f:
+                content = f.read()
+        except OSError:
+            # Another process evicted the content after we read the index.
+            log(f'disk cache content for {key} has disappeared')
+            self.remove(key)
+            return None
+        now = time.time()
+        if now - atime > self._ATIME_RESOLUTION:
+            with self._connection() as db:
+                db.execute('UPDATE entry SET atime = ? WHERE key = ?', (now, key))
+        return content, ctype, stored
+
+
+    def put(self, key, content, ctype, barcode = None):
+        '''Store the byte string "content" of type "ctype" under "key".'''
+        digest = sha256(content).hexdigest()
+        blob = self._blob_path(digest)
+        if not exists(blob):
+            # Write to a temporary file first & then rename, so that readers
+            # in other processes never see a partially-written file.
+            os.makedirs(os.path.dirname(blob), exist_ok = True)
+            tmp = f'{blob}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, blob)
+        with self._connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            old = db.execute('SELECT digest FROM entry WHERE key = ?', (key,)).fetchone()
+            if not self._referenced(db, digest):
+                db.execute('UPDATE usage SET bytes = bytes + ?', (len(content),))
+            now = time.time()
+            db.execute('INSERT OR REPLACE INTO entry (key, digest, ctype, size, atime,'
+                       ' barcode, idle, stored) VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                       (key, digest, ctype, len(content), now, barcode, now))
+            if old and old[0] != digest:
+                self._release(db, old[0])
+            self._evict(db)
+
+
+    def remove(self, key):
+        '''Remove the entry for "key", if there is one.'''
+        with self._connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            found = db.execute('SELECT digest FROM entry WHERE key = ?', (key,)).fetchone()
+            if found:
+                db.execute('DELETE FROM entry WHERE key = ?', (key,))
+                self._release(db, found[0])
+
+
+    def demote(self, barcode):
+        '''Mark the entries of "barcode" as the first candidates for eviction.'''
+        with self._connection() as db:
+            db.execute('UPDATE entry SET idle = 1 WHERE barcode = ?', (barcode,))
+
+
+    def promote(self, barcode):
+        '''Undo the effect of demote(barcode).'''
+        with self._connection() as db:
+            db.execute('UPDATE entry SET idle = 0 WHERE barcode = ?', (barcode,))
+
+
+    def purge(self, barcode):
+        '''Remove all the entries of "barcode".'''
+        with self._connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            query = 'SELECT key, digest FROM entry WHERE barcode = ?'
+            for key, digest in db.execute(query, (barcode,)).fetchall():
+                db.execute('DELETE FROM entry WHERE key = ?', (key,))
+                self._release(db, digest)
+
+
+    def size(self):
+        '''Return the total number of bytes of content currently stored.'''
+        with self._connection() as db:
+            return self._usage(db)
+
+
+    def _connection(self):
+        if not hasattr(self._local, 'db'):
+            # Autocommit mode (isolation_level None) lets us control the
+            # transactions explicitly using BEGIN IMMEDIATE where needed.
+            db = sqlite3.connect(self._index_file, timeout = 30,
+                                 isolation_level = None)
+            db.execute('PRAGMA journal_mode = WAL')
+            self._local.db = db
+        return _Transaction(self._local.db)
+
+
+    def _lookup(self, key):
+        with self._connection() as db:
+            return db.execute('SELECT digest, ctype, atime, stored FROM entry'
+                              ' WHERE key = ?', (key,)).fetchone()
+
+
+    def _blob_path(self, digest):
+        return join(self.cache_dir, digest[:2], digest)
+
+
+    def _referenced(self, db, digest):
+        query = 'SELECT 1 FROM entry WHERE digest = ? LIMIT 1'
+        return db.execute(query, (digest,)).fetchone() is not None
+
+
+    def _usage(self, db):
+        return db.execute('SELECT bytes FROM usage').fetchone()[0]
+
+
+    def _release(self, db, digest):
+        '''Delete the content file for "digest" if no entries refer to it.'''
+        if self._referenced(db, digest):
+            return
+        blob = self._blob_path(digest)
+        try:
+            size = os.path.getsize(blob)
+            os.remove(blob)
+            db.execute('UPDATE usage SET bytes = MAX(0, bytes - ?)', (size,))
+        except OSError:
+            pass
+
+
+    def _evict(self, db):
+        while self._usage(db) > self.max_bytes:
+            victims = db.execute('SELECT key, digest FROM entry ORDER BY idle DESC,'
+                                 ' atime LIMIT ?', (self._EVICTION_BATCH,)).fetchall()
+            if not victims:
+                break
+            for key, digest in victims:
+                log(f'evicting {key} from disk cache')
+                db.execute('DELETE FROM entry WHERE key = ?', (key,))
+                self._release(db, digest)
+                if self._usage(db) <= self.max_bytes:
+                    break
+
+
+class MemoryCache():
+    '''In-memory LRU cache bounded by total bytes and bytes per barcode.
+
+    Entries are stored together with their size in bytes and the barcode of
+    the item they belong to.  Adding an entry first evicts the least-recently
+    used entries of the same barcode until the barcode is within its quota
+    ("max_bytes" times "barcode_share"), then evicts the least-recently used
+    entries overall until the total is within "max_bytes".  Entries larger
+    than the per-barcode quota are not stored at all.
+    '''
+
+    def __init__(self, max_bytes, barcode_share = 1.0):
+        self.max_bytes = max_bytes
+        self.barcode_max_bytes = int(max_bytes * barcode_share)
+        self._entries = OrderedDict()   # key -> (value, size, barcode)
+        self._by_barcode = {}           # barcode -> OrderedDict of keys
+        self._barcode_bytes = {}        # barcode -> total size
+        self._total = 0
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, key):
+        '''Return the value stored for "key", or None if there is none.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self._by_barcode[entry[2]].move_to_end(key)
+            return entry[0]
+
+
+    def put(self, key, value, size, barcode = None):
+        '''Store "value", which takes "size" bytes, under "key".'''
+        if size > self.barcode_max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            keys = self._by_barcode.setdefault(barcode, OrderedDict())
+            while self._barcode_bytes.get(barcode, 0) + size > self.barcode_max_bytes:
+                self._remove(next(iter(keys)))
+            while self._total + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = (value, size, barcode)
+            self._by_barcode.setdefault(barcode, OrderedDict())[key] = True
+            self._barcode_bytes[barcode] = self._barcode_bytes.get(barcode, 0) + size
+            self._total += size
+
+
+    def remove(self, key):
+        '''Remove the entry for "key", if there is one.'''
+        with self._lock:
+            self._remove(key)
+
+
+    def purge(self, barcode):
+        '''Remove all the entries of "barcode".'''
+        with self._lock:
+            for key in list(self._by_barcode.get(barcode, [])):
+                self._remove(key)
+
+
+    def size(self):
+        '''Return the total number of bytes stored.'''
+        return self._total
+
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, barcode = entry
+        self._total -= size
+        self._barcode_bytes[barcode] -= size
+        keys = self._by_barcode[barcode]
+        del keys[key]
+        if not keys:
+            del self._by_barcode[barcode]
+            del self._barcode_bytes[barcode]
+
+
+class ManifestCache():
+    '''In-memory cache of manifest files, transformed & encoded as bytes.
+
+    The function "transform" is called as transform(text, barcode) on the
+    contents of a manifest file when it is first read, and the result is
+    encoded to UTF-8 and cached.  Compressed versions of the result are
+    made when first requested, and cached along with it.  Cached values are
+    reused for as long as the file's modification time, size and inode number
+    stay the same.  The total size of the cache is limited to "max_bytes".
+    '''
+
+    def __init__(self, max_bytes, transform):
+        self.transform = transform
+        self._cache = MemoryCache(max_bytes)
+
+
+    def get(self, path, barcode, encoding = None):
+        '''Return (content, stat) for the manifest in "path", or None.
+
+        If "encoding" is given (e.g., "gzip"), the content is compressed
+        using that encoding.  The value of "stat" is the result of
+        os.stat(path) at the time the file was read.  If the file does not
+        exist, None is returned.
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._cache.remove(path)
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self._cache.get(path)
+        if cached and cached[0] == signature:
+            variants, stat = cached[1], cached[2]
+        else:
+            log(f'reading and rewriting {path}')
+            with open(path, 'r', encoding = 'utf-8') as mf:
+                content = self.transform(mf.read(), barcode).encode()
+            variants = {None: content}
+            self._cache.put(path, (signature, variants, stat), len(content))
+        if encoding not in variants:
+            # Copy the dict so that other threads never see it half-updated.
+            variants = dict(variants, **{encoding: compressed(variants[None], encoding)})
+            size = sum(len(v) for v in variants.values())
+            self._cache.put(path, (signature, variants, stat), size)
+        return variants[encoding], stat
+
+
+class SingleFlight():
+    '''Coalesce concurrent calls of functions for the same key.
+
+    If do(key, fn) is called while another call with the same key is in
+    progress in another thread, it waits for that call to finish and returns
+    its result instead of calling "fn" again.
+    '''
+
+    def __init__(self):
+        self._calls = {}                # key -> _Call
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return key in self._calls
+
+
+    def do(self, key, fn):
+        '''Return fn(), or the result of a concurrent call for the same key.'''
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+            if leader:
+                break
+            call.done.wait()
+            if call.abandoned:
+                continue                # Try again, perhaps as the leader.
+            if call.error:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as ex:         # noqa: PIE786
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+    def start(self, key):
+        '''Start a call for "key" that is made outside of do(...).
+
+        This is for work that can't be wrapped in a function, such as passing
+        content through to a client as it arrives.  If no call for "key" is in
+        progress, this returns a function that must be called when the work is
+        done, as finish(result) to give the result to the callers of do(...)
+        waiting for it, or as finish(abandoned = True) to make them try again
+        themselves.  If a call for "key" is already in progress, this returns
+        None.
+        '''
+        with self._lock:
+            if key in self._calls:
+                return None
+            call = self._calls[key] = _Call()
+
+        def finish(result = None, abandoned = False):
+            with self._lock:
+                if self._calls.get(key) is not call:
+                    return              # Already finished.
+                del self._calls[key]
+            call.result = result
+            call.abandoned = abandoned
+            call.done.set()
+
+        return finish
+
+
+class IIIFCache():
+    '''Two-level cache for IIIF content: in memory, backed by DiskCache.
+
+    Values are (content, ctype) tuples, where content is a byte string and
+    ctype is the MIME content type.  Lookups try the per-process memory
+    cache first and then the shared disk cache (if one is configured), and
+    promote disk hits into memory.
+
+    If "max_age" is given, content stored more than that many seconds ago is
+    stale.  Stale content is still returned, but if the attribute
+    "revalidate" has been set to a function, that function is first called
+    as revalidate(key, barcode) so that it can arrange for the content to be
+    refreshed (e.g., using refresh(...) in a background thread).
+    '''
+
+    # Number of lock files used to coordinate loading across processes.
+    # Keys are spread over them by hash value.
+    _LOCK_STRIPES = 4096
+
+    def __init__(self, memory_cache, disk_cache = None, max_age = None):
+        self.memory = memory_cache
+        self.disk = disk_cache
+        self.max_age = max_age
+        self.revalidate = None
+        self._flights = SingleFlight()
+        if disk_cache is not None:
+            self._lock_dir = join(disk_cache.cache_dir, 'locks')
+            os.makedirs(self._lock_dir, exist_ok = True)
+
+
+    def __contains__(self, key):
+        return key in self.memory or (self.disk is not None and key in self.disk)
+
+
+    def get(self, key, barcode = None, memory_only = False):
+        '''Return (content, ctype) for "key", or None if it's not cached.
+
+        If "memory_only" is True, the disk cache is not consulted.
+        '''
+        # Values in the memory cache are (content, ctype, stored) tuples.
+        value = self.memory.get(key)
+        if value is None and self.disk is not None and not memory_only:
+            try:
+                value = self.disk.entry(key)
+            except (OSError, sqlite3.Error) as ex:
+                log(f'unable to read {key} from disk cache: ' + str(ex))
+                return None
+            if value is not None:
+                self.memory.put(key, value, len(value[0]), barcode)
+        if value is None:
+            return None
+        if self.max_age and self.revalidate and time.time() - value[2] > self.max_age:
+            self.revalidate(key, barcode)
+        return value[:2]
+
+
+    def put(self, key, content, ctype, barcode = None):
+        '''Store "content" of type "ctype" under "key" in all cache levels.'''
+        self.memory.put(key, (content, ctype, time.time()), len(content), barcode)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, content, ctype, barcode)
+            except (OSError, sqlite3.Error) as ex:
+                # Not being able to use the disk cache should not be fatal.
+                log(f'unable to write {key} to disk cache: ' + str(ex))
+
+
+    def remove(self, key):
+        '''Remove "key" from all cache levels.'''
+        self.memory.remove(key)
+        if self.disk is not None:
+            try:
+                self.disk.remove(key)
+            except (OSError, sqlite3.Error) as ex:
+                log(f'unable to remove {key} from disk cache: ' + str(ex))
+
+
+    def refresh(self, key, barcode, loader):
+        '''Replace the value for "key" with the result of calling loader().
+
+        If loader() fails (returns None), the current value is left alone.
+        Returns the result of loader().
+        '''
+        value = loader()
+        if value is not None:
+            self.put(key, *value, barcode)
+        return value
+
+
+    def demote(self, barcode):
+        '''Make the content of "barcode" the first to go when space is needed.
+
+        This is meant for items nobody has on loan.  The content is dropped
+        from memory, and marked in the disk cache as the first to evict.
+        '''
+        self.memory.purge(barcode)
+        self._on_disk('demote', barcode)
+
+
+    def promote(self, barcode):
+        '''Undo the effect of demote(barcode) in the disk cache.'''
+        self._on_disk('promote', barcode)
+
+
+    def purge(self, barcode):
+        '''Remove all the content of "barcode" from the cache.'''
+        self.memory.purge(barcode)
+        self._on_disk('purge', barcode)
+
+
+    def load(self, key, barcode, loader):
+        '''Return the value for "key", calling loader() if it's not cached.
+
+        The function "loader" must return a (content, ctype) tuple, or None
+        if it fails.  Concurrent calls for the same key, whether in threads
+        of this process or in other processes sharing the disk cache, are
+        coalesced so that "loader" is only called once.
+        '''
+        value = self.get(key, barcode)
+        if value is not None:
+            return value
+        return self._flights.do(key, lambda: self._load(key, barcode, loader))
+
+
+    def loading(self, key):
+        '''Return True if a thread in this process is loading "key".'''
+        return key in self._flights
+
+
+    def start_loading(self, key):
+        '''Tell load(...) that the caller is getting the value for "key".
+
+        This is for content that is loaded while it's sent to a client.
+        Returns None if "key" is already being loaded in this process, and
+        otherwise a function to call when done, with the (content, ctype)
+        that was stored using put(...), or with abandoned = True if the
+        content could not be loaded completely.  Calls of load(...) for the
+        same key in this process wait until then.  (Other processes are not
+        made to wait.)
+        '''
+        return self._flights.start(key)
+
+
+    def _on_disk(self, operation, barcode):
+        if self.disk is not None:
+            try:
+                getattr(self.disk, operation)(barcode)
+            except (OSError, sqlite3.Error) as ex:
+                log(f'unable to {operation} {barcode} in disk cache: ' + str(ex))
+
+
+    def _load(self, key, barcode, loader):
+        with self._process_lock(key):
+            # Another process may have loaded it while we waited for the lock.
+            value = self.get(key, barcode)
+            if value is None:
+                value = loader()
+                if value is not None:
+                    self.put(key, *value, barcode)
+            return value
+
+
+    @contextmanager
+    def _process_lock(self, key):
+        if self.disk is None:
+            yield
+            return
+        stripe = int(sha256(key.encode()).hexdigest()[:8], 16) % self._LOCK_STRIPES
+        try:
+            lock_file = open(join(self._lock_dir, f'{stripe:04d}'), 'a')
+        except OSError as ex:
+            log(f'unable to open lock file for {key}: ' + str(ex))
+            yield
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+# Miscellaneous helpers.
+# .............................................................................
+
+class _Call():
+    '''Record of a call in progress in a SingleFlight object.'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+
+
+class _Transaction():
+    '''Context manager that rolls back an explicit transaction on errors.'''
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.db.in_transaction:
+            if exc_type is None:
+                self.db.execute('COMMIT')
+            else:
+                self.db.execute('ROLLBACK')
+        return False
@@ -0,0 +1,64 @@
+'''
+compression.py: HTTP content encoding negotiation and compression
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Constants.
+# .............................................................................
+
+# Encodings we can produce, in order of preference.
+ENCODINGS = (['br'] if brotli else []) + ['gzip']
+
+# Content smaller than this is not worth compressing.
+MIN_SIZE = 1024
+
+
+# Exported functions.
+# .............................................................................
+
+def negotiated_encoding(accept_encoding):
+    '''Return the best encoding allowed by an Accept-Encoding value, or None.
+
+    Encodings are chosen among those in ENCODINGS.  If none of them are
+    acceptable to the client, None is returned (meaning no compression).
+    '''
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    candidates = [(weights.get(enc, weights.get('*', 0.0)), -index, enc)
+                  for index, enc in enumerate(ENCODINGS)]
+    weight, _, best = max(candidates)
+    return best if weight > 0 else None
+
+
+def compressed(content, encoding):
+    '''Return the byte string "content" compressed using "encoding".'''
+    if encoding == 'br':
+        return brotli.compress(content)
+    elif encoding == 'gzip':
+        return gzip.compress(content, compresslevel = 6, mtime = 0)
+    raise ValueError(f'Unsupported encoding {encoding}')
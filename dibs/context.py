@@ -0,0 +1,77 @@
+'''
+context.py: per-request memoization of the things routes look up
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from .data_models import Item, Loan
+from .people import person_from_environ
+from .roles import staff_user
+
+
+# Exported classes.
+# .............................................................................
+
+class RequestContext():
+    '''Memoize the person, staff status, items and loans for a request.
+
+    One is created for each request by request_context() in server.py, so
+    that the plugins, route functions and templates share what they look up.
+    "environ" is the WSGI environment of the request.  Values that are not
+    found (e.g., an unknown barcode) are remembered as None.
+    '''
+
+    def __init__(self, environ):
+        self.environ = environ
+        self._person = None
+        self._staff = None
+        self._items = {}                # barcode -> Item or None
+        self._loans = {}                # (barcode, uname) -> Loan or None
+
+
+    @property
+    def person(self):
+        '''The Person or GuestPerson making the request, or None if unknown.'''
+        if self._person is None:
+            self._person = person_from_environ(self.environ)
+        return self._person
+
+
+    @property
+    def staff(self):
+        '''True if the person making the request is a staff user.'''
+        if self._staff is None:
+            self._staff = staff_user(self.person)
+        return self._staff
+
+
+    def item(self, barcode):
+        '''Return the Item with the given barcode, or None.'''
+        if barcode not in self._items:
+            self._items[barcode] = Item.get_or_none(Item.barcode == barcode)
+        return self._items[barcode]
+
+
+    def loan(self, barcode, uname):
+        '''Return the Loan of barcode to uname (in any state), or None.'''
+        key = (barcode, uname)
+        if key not in self._loans:
+            item = self.item(barcode)
+            self._loans[key] = item and Loan.get_or_none(Loan.item == item,
+                                                         Loan.user == uname)
+        return self._loans[key]
+
+
+    def reload(self):
+        '''Forget the items and loans looked up so far.
+
+        This must be called after acquiring a database lock, if what was
+        read before may have been changed by other requests.
+        '''
+        self._items.clear()
+        self._loans.clear()
@@ -13,8 +13,9 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from contextlib import contextmanager
 from peewee import SqliteDatabase, Model
-from peewee import CharField, TextField, SmallIntegerField
+from peewee import CharField, TextField, SmallIntegerField, IntegerField
 from peewee import ForeignKeyField, DateTimeField, BooleanField, TimestampField
 from playhouse.reflection import generate_models
 
@@ -27,12 +28,42 @@ from .settings import config, resolved_path
 # managers on the database object to perform some atomic operations.
 
 _db_path = resolved_path(config('DATABASE_FILE'))
-database = SqliteDatabase(_db_path, autoconnect = False)
+
+# Settings applied to every connection.  (The order matters: the busy timeout
+# must be set before changing the journal mode, which may need to wait.)
+_pragmas = [
+    ('busy_timeout', int(config('SQLITE_BUSY_TIMEOUT', default = 5000))),
+    ('journal_mode', config('SQLITE_JOURNAL_MODE', default = 'wal')),
+    ('synchronous', config('SQLITE_SYNCHRONOUS', default = 'normal')),
+    ('cache_size', int(config('SQLITE_CACHE_SIZE', default = -8000))),
+    ('mmap_size', int(config('SQLITE_MMAP_SIZE', default = 67108864))),
+]
+
+# Peewee keeps a separate connection for each thread.
+database = SqliteDatabase(_db_path, autoconnect = False, pragmas = _pragmas)
 
 # Annotate our database object with a path to the file we're using. This saves
 # us from having to duplicate the path resolution logic elsewhere. Keep it DRY!
 database.file_path = _db_path
 
+
+def set_read_only(read_only):
+    '''Make the current thread's database connection read-only, or not.'''
+    database.pragma('query_only', int(read_only))
+
+
+@contextmanager
+def writable():
+    '''Allow changes to the database even if the connection is read-only.'''
+    read_only = database.pragma('query_only')
+    if read_only:
+        set_read_only(False)
+    try:
+        yield
+    finally:
+        if read_only:
+            set_read_only(True)
+
 
 # Database object schemas.
 # .............................................................................
@@ -189,6 +220,19 @@ class Person(BaseModel):
     def has_role(self, required_role):
         return self.role == required_role
 
+
+class Counter(BaseModel):
+    '''A named number that is incremented when something changes.
+
+    DIBS server processes keep copies of some things from the database in
+    memory (e.g., Person records).  Programs that change those things, such as
+    people-manager, increment a counter so that the server processes know to
+    discard their copies.
+    '''
+
+    name  = CharField(primary_key = True)
+    value = IntegerField(default = 0)
+
 
 # Initialization.
 # .............................................................................
@@ -199,4 +243,6 @@ class Person(BaseModel):
 database.connect()
 if generate_models(database) == {}:
     database.create_tables([Item, Loan, History, Person])
+# Counter was added later; this does nothing if the table already exists.
+database.create_tables([Counter])
 database.close()
@@ -11,7 +11,7 @@ file "LICENSE" for more information.
 
 import arrow
 from   datetime import datetime as dt
-from   datetime import timedelta
+from   datetime import timedelta, timezone
 
 
 # Exported functions.
@@ -36,3 +36,8 @@ def round_minutes(time, direction):
 def time_now():
     '''Return datetime.utcnow() but with microseconds zeroed out.'''
     return dt.utcnow().replace(microsecond = 0)
+
+
+def timestamp(time):
+    '''Return the POSIX timestamp for a datetime in UTC without a time zone.'''
+    return time.replace(tzinfo = timezone.utc).timestamp()
@@ -0,0 +1,324 @@
+'''
+iiif_utils.py: miscellaneous utilities for working with IIIF URLs & manifests
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   copy import deepcopy
+from   functools import lru_cache
+import json
+from   math import ceil, isqrt
+import os
+import re
+
+
+# Internal constants.
+# .............................................................................
+
+_ROTATION = re.compile(r'^!?\d+(\.\d+)?$')
+_QUALITY_FORMAT = re.compile(r'^[a-z]+\.[a-z0-9]+$')
+
+
+# Exported functions.
+# .............................................................................
+
+def image_request_parts(url):
+    '''Split a IIIF Image API request URL into its service and parameters.
+
+    Returns a tuple (service, region, size, rotation, quality_format), where
+    "service" is the base URL of the image service (including the image
+    identifier), or None if "url" does not look like an image request.
+    '''
+    parts = url.rsplit('/', 4)
+    if (len(parts) != 5 or not _ROTATION.match(parts[3])
+            or not _QUALITY_FORMAT.match(parts[4])):
+        return None
+    return tuple(parts)
+
+
+def adjacent_tile_urls(url, info):
+    '''Return URLs for the tiles next to the one requested by "url".
+
+    "info" must be the dict parsed from the info.json file of the image
+    service.  Only requests for regions given as "x,y,w,h" and sizes given as
+    "w," or "w,h" are understood; for others, an empty list is returned.
+    '''
+    parts = image_request_parts(url)
+    if not parts:
+        return []
+    service, region, size, rotation, quality_format = parts
+    try:
+        x, y, w, h = (int(v) for v in region.split(','))
+        size_w = int(size.split(',')[0])
+        width, height = int(info['width']), int(info['height'])
+    except (ValueError, KeyError, TypeError):
+        return []
+    if size_w <= 0 or w <= 0 or h <= 0:
+        return []
+
+    # Tiles at the right & bottom edges may be smaller than the others, so
+    # base the step between tiles on the tile size in info.json if possible.
+    scale = max(1, round(w / size_w))
+    tile_w = tile_h = None
+    for tiles in info.get('tiles', []):
+        if scale in tiles.get('scaleFactors', []):
+            tile_w = tiles.get('width')
+            tile_h = tiles.get('height', tile_w)
+            break
+    step_w = tile_w * scale if tile_w else w
+    step_h = tile_h * scale if tile_h else h
+
+    urls = []
+    for nx, ny in [(x + step_w, y), (x, y + step_h), (x - step_w, y), (x, y - step_h)]:
+        if nx < 0 or ny < 0 or nx >= width or ny >= height:
+            continue
+        nw = min(step_w, width - nx)
+        nh = min(step_h, height - ny)
+        if size.endswith(','):
+            new_size = f'{ceil(nw / scale)},'
+        else:
+            new_size = f'{ceil(nw / scale)},{ceil(nh / scale)}'
+        urls.append('/'.join([service, f'{nx},{ny},{nw},{nh}', new_size,
+                              rotation, quality_format]))
+    return urls
+
+
+def coarsest_tile_urls(service, info):
+    '''Return URLs for the tiles of the lowest-resolution level of an image.
+
+    "info" must be the dict parsed from the info.json file of the image
+    service.  The URLs are made the way OpenSeadragon (used by the Universal
+    Viewer) makes them, so that they match what a viewer first asks for.
+    '''
+    try:
+        width, height = int(info['width']), int(info['height'])
+        tiles = info['tiles'][0]
+        tile_w = int(tiles['width'])
+        tile_h = int(tiles.get('height', tile_w))
+        scale = int(max(tiles.get('scaleFactors') or [1]))
+    except (ValueError, KeyError, IndexError, TypeError):
+        return []
+    if min(width, height, tile_w, tile_h, scale) <= 0:
+        return []
+
+    version3 = 'image/3' in str(info.get('@context', ''))
+    level_w, level_h = ceil(width / scale), ceil(height / scale)
+    if level_w < tile_w and level_h < tile_h:
+        # The whole image fits in one tile at this level.
+        if level_w == width:
+            size = 'max' if version3 else 'full'
+        else:
+            size = f'{level_w},{level_h}' if version3 else f'{level_w},'
+        return [f'{service}/full/{size}/0/default.jpg']
+
+    urls = []
+    step_w, step_h = tile_w * scale, tile_h * scale
+    for y in range(0, height, step_h):
+        for x in range(0, width, step_w):
+            w, h = min(step_w, width - x), min(step_h, height - y)
+            if version3:
+                size = f'{ceil(w / scale)},{ceil(h / scale)}'
+            else:
+                size = f'{ceil(w / scale)},'
+            urls.append(f'{service}/{x},{y},{w},{h}/{size}/0/default.jpg')
+    return urls
+
+
+def retiled_info(info, tile_size):
+    '''Return a copy of the info.json data "info" with tiles of "tile_size".
+
+    Viewers showing the image will then ask for fewer, larger tiles.  Tiles
+    are only ever made larger, by a whole multiple of their original size (so
+    they line up with the original tiles), and never beyond the limits given
+    by maxWidth, maxHeight or maxArea.  Scale factors past the first one at
+    which the whole image fits in a tile are dropped, since each would only
+    add another single-tile view of the whole image.  If the image service
+    has compliance level 0, it can only produce its own tiles, so "info" is
+    returned unchanged.
+    '''
+    if _compliance_level(info) == 0:
+        return info
+    try:
+        limits = [int(tile_size)]
+        for source in [info] + [p for p in _as_list(info.get('profile')) if isinstance(p, dict)]:
+            limits += [int(source[key]) for key in ['maxWidth', 'maxHeight'] if key in source]
+            if 'maxArea' in source:
+                limits.append(isqrt(int(source['maxArea'])))
+        width, height = int(info['width']), int(info['height'])
+        limit = min(limits)
+        new_tiles = []
+        for tiles in info['tiles']:
+            tile_w = int(tiles['width'])
+            tile_h = int(tiles.get('height', tile_w))
+            factor = max(1, limit // max(tile_w, tile_h))
+            new_w, new_h = tile_w * factor, tile_h * factor
+            new = dict(tiles, width = new_w)
+            if 'height' in tiles:
+                new['height'] = new_h
+            scale_factors = []
+            for scale in sorted(tiles.get('scaleFactors', [])):
+                scale_factors.append(scale)
+                if ceil(width / scale) <= new_w and ceil(height / scale) <= new_h:
+                    break
+            if scale_factors:
+                new['scaleFactors'] = scale_factors
+            new_tiles.append(new)
+    except (ValueError, KeyError, TypeError, ZeroDivisionError):
+        return info
+    return dict(info, tiles = new_tiles)
+
+
+def next_service(service, manifest_file):
+    '''Return the image service following "service" in the manifest file.
+
+    Returns None if "service" is not in the manifest or is the last one.
+    '''
+    services = manifest_services(manifest_file)
+    try:
+        index = services.index(service)
+    except ValueError:
+        return None
+    return services[index + 1] if index + 1 < len(services) else None
+
+
+def manifest_services(manifest_file):
+    '''Return the list of image service URLs in a manifest, in canvas order.'''
+    return [service for service, _ in manifest_pages(manifest_file)]
+
+
+def manifest_pages(manifest_file):
+    '''Return a list of (service, thumbnail) tuples for a manifest file.
+
+    See pages_in_manifest(...) for more information.
+    '''
+    try:
+        mtime = os.stat(manifest_file).st_mtime_ns
+    except OSError:
+        return []
+    return _manifest_pages(manifest_file, mtime)
+
+
+def services_in_manifest(manifest):
+    '''Return the image service URLs in a parsed IIIF manifest.'''
+    return [service for service, _ in pages_in_manifest(manifest)]
+
+
+def pages_in_manifest(manifest):
+    '''Return a list of (service, thumbnail) tuples for a parsed IIIF manifest.
+
+    There is one tuple for each canvas that has an image service, in canvas
+    order.  The value of "thumbnail" is the URL of the canvas thumbnail, or
+    None if the canvas does not have one.  This handles both version 2
+    (sequences/canvases/images) and version 3 (items/items/items) of the
+    IIIF Presentation API.
+    '''
+    pages = []
+    if 'sequences' in manifest:
+        for sequence in manifest['sequences']:
+            for canvas in sequence.get('canvases', []):
+                thumbnail = _resource_id(canvas.get('thumbnail'))
+                for image in canvas.get('images', []):
+                    services = _service_ids(image.get('resource', {}))
+                    pages += [(service, thumbnail) for service in services]
+    else:
+        for canvas in manifest.get('items', []):
+            thumbnail = _resource_id(canvas.get('thumbnail'))
+            for page in canvas.get('items', []):
+                for annotation in page.get('items', []):
+                    services = _service_ids(annotation.get('body', {}))
+                    pages += [(service, thumbnail) for service in services]
+    return pages
+
+
+def single_image_manifest(manifest, width):
+    '''Return a copy of a parsed IIIF manifest with one image per canvas.
+
+    Each image that has an image service is replaced by a single image made
+    by that service, "width" pixels wide (or full size, if it's narrower), so
+    that a viewer can show each page with one request instead of many tile
+    requests.  This handles both version 2 and version 3 of the IIIF
+    Presentation API.
+    '''
+    manifest = deepcopy(manifest)
+    if 'sequences' in manifest:
+        for sequence in manifest['sequences']:
+            for canvas in sequence.get('canvases', []):
+                for image in canvas.get('images', []):
+                    _make_single_image(image.get('resource', {}), width, '@id', 'full')
+    else:
+        for canvas in manifest.get('items', []):
+            for page in canvas.get('items', []):
+                for annotation in page.get('items', []):
+                    _make_single_image(annotation.get('body', {}), width, 'id', 'max')
+    return manifest
+
+
+# Internal utilities.
+# .............................................................................
+
+@lru_cache(maxsize = 32)
+def _manifest_pages(manifest_file, mtime):
+    # The mtime argument is only there to make the cache key change when the
+    # file changes.
+    with open(manifest_file, 'r', encoding = 'utf-8') as mf:
+        return pages_in_manifest(json.load(mf))
+
+
+def _make_single_image(resource, width, id_key, full_size):
+    services = _service_ids(resource)
+    if not services:
+        return
+    try:
+        full_w, full_h = int(resource['width']), int(resource['height'])
+    except (ValueError, KeyError, TypeError):
+        full_w = full_h = None
+    if not full_w or not full_h:
+        size = f'{width},'
+        resource.pop('width', None)
+        resource.pop('height', None)
+    elif full_w > width:
+        size = f'{width},'
+        resource['width'], resource['height'] = width, round(full_h * width / full_w)
+    else:
+        size = full_size
+    resource[id_key] = f'{services[0]}/full/{size}/0/default.jpg'
+    resource['format'] = 'image/jpeg'
+    del resource['service']
+
+
+def _compliance_level(info):
+    # In version 2, the profile is a URL such as ".../level1.json", possibly
+    # as the first element of a list; in version 3, it's a name like "level1".
+    profile = next(iter(_as_list(info.get('profile'))), '')
+    match = re.search(r'level(\d)(\.json)?$', profile if isinstance(profile, str) else '')
+    return int(match.group(1)) if match else None
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _service_ids(resource):
+    service = resource.get('service')
+    if isinstance(service, dict):
+        service = [service]
+    if not isinstance(service, list):
+        return []
+    ids = [s.get('@id') or s.get('id') for s in service if isinstance(s, dict)]
+    return [i.rstrip('/') for i in ids if i][:1]
+
+
+def _resource_id(resource):
+    # Thumbnails can be given as a URL, an object, or a list of objects.
+    if isinstance(resource, list):
+        resource = resource[0] if resource else None
+    if isinstance(resource, dict):
+        resource = resource.get('@id') or resource.get('id')
+    return resource if isinstance(resource, str) else None
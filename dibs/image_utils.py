@@ -12,7 +12,30 @@ file "LICENSE" for more information.
 from io import BytesIO
 from PIL import Image
 
-
+try:
+    # Versions of Pillow before 11.2 need a plugin to write AVIF images.
+    import pillow_avif                  # noqa: F401
+except ImportError:
+    pass
+
+
+# Internal constants.
+# .............................................................................
+
+# Pillow format names for the image types that images can be converted to.
+_PIL_FORMATS = {'image/webp': 'WEBP', 'image/avif': 'AVIF'}
+
+# Offsets and leading bytes identifying the image types served by IIIF servers.
+_SIGNATURES = [(0, b'\xff\xd8\xff', 'image/jpeg'),
+               (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+               (0, b'GIF8', 'image/gif'),
+               (8, b'WEBP', 'image/webp'),
+               (4, b'ftypavif', 'image/avif'),
+               (0, b'\x00\x00\x00\x0cjP  \r\n\x87\n', 'image/jp2'),
+               (0, b'II*\x00', 'image/tiff'),
+               (0, b'MM\x00*', 'image/tiff')]
+
+
 # Exported functions
 # .............................................................................
 
@@ -24,3 +47,54 @@ def as_jpeg(byte_array):
     img.save(buffer, 'JPEG')
     img.close()
     return buffer.getvalue()
+
+
+def converted(byte_array, ctype, quality = 80):
+    '''Convert an image, stored as an array of bytes, to MIME type "ctype".
+
+    "ctype" must be one of the types returned by conversion_types().
+    '''
+    img = Image.open(BytesIO(byte_array))
+    if img.mode not in ['RGB', 'RGBA']:
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, _PIL_FORMATS[ctype], quality = quality)
+    img.close()
+    return buffer.getvalue()
+
+
+def conversion_types():
+    '''Return the MIME types that converted(...) can produce.
+
+    This depends on how Pillow was built; AVIF in particular is often missing.
+    '''
+    Image.init()
+    return [ctype for ctype, name in _PIL_FORMATS.items() if name in Image.SAVE]
+
+
+def image_type(byte_array):
+    '''Return the MIME type of an image stored as an array of bytes, or None.'''
+    for offset, signature, ctype in _SIGNATURES:
+        if byte_array[offset:offset + len(signature)] == signature:
+            return ctype
+    return None
+
+
+def negotiated_image_type(accept, ctypes):
+    '''Return the first of "ctypes" named in an Accept header value, or None.
+
+    Only types that the client lists explicitly count; a client that accepts
+    "image/*" may still not be able to display, e.g., AVIF images.
+    '''
+    accepted = set()
+    for item in (accept or '').split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return next((ctype for ctype in ctypes if ctype in accepted), None)
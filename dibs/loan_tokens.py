@@ -0,0 +1,93 @@
+'''
+loan_tokens.py: signed tokens showing that a person has an item on loan
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   base64 import urlsafe_b64encode
+import hashlib
+import hmac
+import os
+from   os.path import exists, join
+from   sidetrack import log
+import time
+
+from .date_utils import timestamp
+
+
+# Exported classes.
+# .............................................................................
+
+class LoanTokens():
+    '''Issue and verify loan tokens signed with "secret".
+
+    A token is bound to a person, an item and the end time of a loan, and lets
+    requests for the item's content skip checking the loan in the database.
+    Tokens of loans that end early must be revoked.  Revocations are recorded in the directory "revoked_dir", which is created
+    if necessary.  Loan end times are naive datetime objects in UTC, as they
+    are in the database.
+    '''
+
+    def __init__(self, secret, revoked_dir):
+        self.secret = secret.encode()
+        self.revoked_dir = revoked_dir
+
+
+    def issue(self, uname, barcode, end_time):
+        '''Return a token for the loan of barcode to uname ending at end_time.'''
+        end = int(timestamp(end_time))
+        return f'{end}.{self._signature(uname, barcode, end)}'
+
+
+    def verify(self, token, uname, barcode):
+        '''Return True if "token" shows that uname has barcode on loan now.'''
+        end, _, signature = (token or '').partition('.')
+        try:
+            end = int(end)
+        except ValueError:
+            return False
+        if end <= time.time():
+            return False
+        if not hmac.compare_digest(signature, self._signature(uname, barcode, end)):
+            log(f'invalid loan token for {barcode}')
+            return False
+        return not exists(join(self.revoked_dir, self._key(uname, barcode, end)))
+
+
+    def revoke(self, uname, barcode, end_time):
+        '''Make tokens for the loan of barcode to uname invalid.'''
+        end = int(timestamp(end_time))
+        if end <= time.time():
+            return
+        os.makedirs(self.revoked_dir, exist_ok = True)
+        self._prune()
+        path = join(self.revoked_dir, self._key(uname, barcode, end))
+        with open(path, 'w'):
+            pass
+        # The file is only needed until the token would expire anyway.
+        os.utime(path, (end, end))
+
+
+    def _signature(self, uname, barcode, end):
+        message = f'{uname}\n{barcode}\n{end}'.encode()
+        digest = hmac.new(self.secret, message, hashlib.sha256).digest()
+        return urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+    def _key(self, uname, barcode, end):
+        return hashlib.sha256(f'{uname}\n{barcode}\n{end}'.encode()).hexdigest()
+
+
+    def _prune(self):
+        now = time.time()
+        for entry in os.scandir(self.revoked_dir):
+            try:
+                if entry.stat().st_mtime <= now:
+                    os.remove(entry.path)
+            except OSError:
+                pass                    # Another process may have removed it.
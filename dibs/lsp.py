@@ -21,6 +21,7 @@ from   sidetrack import log
 from   textwrap import wrap
 from   topi import Tind
 
+from .network import session
 from .settings import config, resolved_path
 
 
@@ -290,7 +291,7 @@ def save_thumbnail(dest_file, url = None, isbn = None):
         log(f'cover_image returned image at {url}')
     # We were either given a url in the call, or we found one using the isbn.
     elif url:
-        (response, error) = net('get', url)
+        (response, error) = net('get', url, client = session())
         if not error and response.status_code == 200:
             log(f'got image from {url}')
             image = response.content
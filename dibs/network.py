@@ -0,0 +1,306 @@
+'''
+network.py: shared HTTP clients for DIBS's requests to other servers
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import asyncio
+from   collections import deque
+from   concurrent.futures import as_completed, wait
+import httpx
+import os
+from   sidetrack import log
+import threading
+import time
+
+from .prefetch import pid_local_pool
+from .settings import config
+
+
+# Internal variables.
+# .............................................................................
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+_async_client = None
+_async_client_loop = None
+
+
+# Exported functions.
+# .............................................................................
+
+def session():
+    '''Return the HTTPX client for this process, creating it if necessary.
+
+    The client keeps a pool of persistent connections and uses HTTP/2 with
+    servers that support it.  Each process gets its own, because connections
+    can't be shared with processes forked later.  It's configured using the
+    UPSTREAM_* settings described in settings.ini-example.
+    '''
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = httpx.Client(**_client_options())
+            _client_pid = os.getpid()
+        return _client
+
+
+def async_session():
+    '''Return the asynchronous HTTPX client for the running event loop.
+
+    This must be called from a coroutine.  The client is created the first
+    time it's requested in an event loop, with the same settings as the
+    client returned by session().
+    '''
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(**_client_options())
+        _async_client_loop = loop
+    return _async_client
+
+
+def hedged(function, delay, ok, slots = None):
+    '''Call function(), calling it a second time if it's slow to return.
+
+    If the first call has not returned after "delay" seconds, a second call
+    is started in parallel, and the first result for which ok(result) is
+    true is returned (or if neither is, the last one).  The calls run in a
+    pool of threads; a call that is no longer needed can't be interrupted,
+    but its result is ignored.  The delay is counted from when the first
+    call starts, not from when it's put in the pool's queue, so that time
+    spent waiting for a free thread is not mistaken for a slow server.  If
+    "delay" is None, function() is simply called in the current thread.
+
+    Because the slower call keeps running (and holding a thread and a
+    network connection), the number of second calls can be limited using
+    "slots", a threading.Semaphore.  A slot is taken for each second call
+    and given back when both calls have finished; if no slot is free, no
+    second call is made.
+    '''
+    if delay is None:
+        return function()
+    started = threading.Event()
+
+    def first_call():
+        started.set()
+        return function()
+
+    pool = _hedge_pool()
+    futures = [pool.submit(first_call)]
+    started.wait()
+    done, _ = wait(futures, timeout = delay)
+    if not done:
+        if slots is None or slots.acquire(blocking = False):
+            log(f'no result after {delay:.3f} s; making a hedged request')
+            futures.append(pool.submit(function))
+            if slots is not None:
+                _release_when_done(futures, slots)
+        else:
+            log(f'no result after {delay:.3f} s, but too many hedged requests')
+    result = None
+    for future in as_completed(futures):
+        result = future.result()
+        if ok(result):
+            break
+    for future in futures:
+        future.cancel()
+    return result
+
+
+async def async_hedged(function, delay, ok):
+    '''Asynchronous version of hedged(...), for coroutine functions.
+
+    The call that is no longer needed is cancelled.
+    '''
+    if delay is None:
+        return await function()
+    tasks = {asyncio.ensure_future(function())}
+    done, pending = await asyncio.wait(tasks, timeout = delay)
+    if not done:
+        log(f'no result after {delay:.3f} s; making a hedged request')
+        pending.add(asyncio.ensure_future(function()))
+    result = None
+    try:
+        while True:
+            for task in done:
+                result = task.result()
+                if ok(result):
+                    return result
+            if not pending:
+                return result
+            done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Exported classes.
+# .............................................................................
+
+class Backends():
+    '''Choose among equivalent servers based on their recent performance.
+
+    "canonical" is the base URL of the main server, which is also the base
+    URL used in URLs given to url_for(...), and "urls" is a list of base URLs
+    of additional servers with the same content.  The attribute "urls" lists
+    all of them, starting with the main server.  Servers are chosen by
+    choose(...) based on their average response time and the number of
+    requests in progress on them.  A server that fails "max_errors" times in
+    a row is considered down for "down_time" seconds; after that, it's given
+    another chance, and the first success puts it back in service.
+    '''
+
+    # Weight given to the newest measurement in the average response time.
+    _ALPHA = 0.2
+
+    def __init__(self, canonical, urls, max_errors = 3, down_time = 30):
+        self.canonical = canonical.rstrip('/')
+        self.urls = [self.canonical]
+        for url in urls:
+            if url.rstrip('/') not in self.urls:
+                self.urls.append(url.rstrip('/'))
+        self.max_errors = max_errors
+        self.down_time = down_time
+        self._latency = {url: 0.0 for url in self.urls}
+        self._in_flight = {url: 0 for url in self.urls}
+        self._errors = {url: 0 for url in self.urls}
+        self._down_until = {url: 0.0 for url in self.urls}
+        self._lock = threading.Lock()
+
+
+    def choose(self, exclude = ()):
+        '''Return the base URL of the best server not in "exclude", or None.
+
+        If all the candidates are down, the one due back soonest is returned.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            candidates = [url for url in self.urls if url not in exclude]
+            if not candidates:
+                return None
+            up = [url for url in candidates if self._down_until[url] <= now]
+            if not up:
+                return min(candidates, key = lambda url: self._down_until[url])
+            return min(up, key = lambda url: self._latency[url] * (self._in_flight[url] + 1))
+
+
+    def url_for(self, url, base):
+        '''Return "url" with the canonical base URL replaced by "base".'''
+        if url.startswith(self.canonical):
+            return base + url[len(self.canonical):]
+        return url
+
+
+    def started(self, base):
+        '''Record that a request to server "base" has started.'''
+        with self._lock:
+            self._in_flight[base] += 1
+
+
+    def cancelled(self, base):
+        '''Record that a request to "base" was abandoned before it finished.'''
+        with self._lock:
+            self._in_flight[base] -= 1
+
+
+    def finished(self, base, elapsed, ok):
+        '''Record the end of a request to "base" that took "elapsed" seconds.
+
+        "ok" must be False if the request failed because of a problem with
+        the server or the network (as opposed to, e.g., a 404 response).
+        '''
+        with self._lock:
+            self._in_flight[base] -= 1
+            if ok:
+                self._errors[base] = 0
+                self._down_until[base] = 0.0
+                old = self._latency[base]
+                self._latency[base] = elapsed if not old else (
+                    self._ALPHA * elapsed + (1 - self._ALPHA) * old)
+            else:
+                self._errors[base] += 1
+                if self._errors[base] >= self.max_errors:
+                    if self._down_until[base] <= time.monotonic():
+                        log(f'marking {base} as down for {self.down_time} s')
+                    self._down_until[base] = time.monotonic() + self.down_time
+
+
+class Latencies():
+    '''Keep the most recent "size" response times, to compute percentiles.
+
+    percentile(...) returns None until at least "min_count" response times
+    have been added, because a percentile of a few values is meaningless.
+    '''
+
+    def __init__(self, size = 500, min_count = 20):
+        self.min_count = min_count
+        self._times = deque(maxlen = size)
+        self._lock = threading.Lock()
+
+
+    def add(self, elapsed):
+        '''Add a response time of "elapsed" seconds.'''
+        with self._lock:
+            self._times.append(elapsed)
+
+
+    def percentile(self, p):
+        '''Return the p-th percentile of the response times, or None.'''
+        with self._lock:
+            if len(self._times) < self.min_count:
+                return None
+            times = sorted(self._times)
+        return times[min(len(times) - 1, int(len(times) * p / 100))]
+
+
+# Internal utilities.
+# .............................................................................
+
+def _release_when_done(futures, semaphore):
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                semaphore.release()
+
+    for future in futures:
+        future.add_done_callback(finished)
+
+
+def _hedge_pool():
+    # There's no point in having more threads than the client has connections.
+    return pid_local_pool('hedge', int(config('UPSTREAM_POOL_SIZE', default = 20)))
+
+
+def _client_options():
+    pool_size = int(config('UPSTREAM_POOL_SIZE', default = 20))
+    keepalive = float(config('UPSTREAM_KEEPALIVE', default = 30))
+    timeout   = float(config('UPSTREAM_TIMEOUT', default = 30))
+    connect   = float(config('UPSTREAM_CONNECT_TIMEOUT', default = 5))
+    read      = float(config('UPSTREAM_READ_TIMEOUT', default = timeout))
+    http2     = config('UPSTREAM_HTTP2', default = True, cast = bool)
+    if http2:
+        # HTTPX needs the optional package "h2" for HTTP/2 support.
+        try:
+            import h2                   # noqa: F401
+        except ImportError:
+            log('package h2 is not installed; not using HTTP/2')
+            http2 = False
+    log(f'creating HTTP client with pool size {pool_size} for process {os.getpid()}')
+    limits = httpx.Limits(max_connections = pool_size,
+                          max_keepalive_connections = pool_size,
+                          keepalive_expiry = keepalive)
+    timeouts = httpx.Timeout(timeout, connect = connect, read = read)
+    return dict(limits = limits, timeout = timeouts, http2 = http2,
+                follow_redirects = True)
@@ -27,12 +27,25 @@ from rich.padding import Padding
 from rich.table import Table
 from sidetrack import log
 from subprocess import Popen, PIPE
+from threading import Lock
+from time import monotonic
 
 import os
 import sys
 
-from .data_models import Person
+from .data_models import Counter, Person
 from .date_utils import human_datetime
+from .settings import config
+
+
+# Roles change rarely (staff come and go perhaps once a month), so server
+# processes keep Person records in memory for this many seconds rather than
+# look them up on every request.  Unknown user names (i.e., patrons) are
+# remembered too.  Setting this to 0 turns the cache off.
+_PERSON_CACHE_SECONDS = int(config('PERSON_CACHE_SECONDS', default = 300))
+
+# Name of the Counter that PersonManager increments when it changes people.
+_PEOPLE_COUNTER = 'people'
 
 
 def setup_person_table(db_name):
@@ -63,6 +76,82 @@ class GuestPerson():
         return self.role == required_role
 
 
+class PersonCache():
+    '''Process-wide cache of Person records, keyed by user name.
+
+    Entries expire after "ttl" seconds.  The whole cache is cleared when
+    the Counter named "people" changes, which is checked at most once every
+    "check_interval" seconds, so that changes made with people-manager are
+    seen by all server processes within that time.
+    '''
+
+    def __init__(self, ttl, check_interval = 5, max_entries = 10000):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self._entries = {}              # uname -> (expiration, Person or None)
+        self._generation = None
+        self._next_check = 0
+        self._lock = Lock()
+
+
+    def get(self, uname):
+        '''Return the Person with the given uname, or None if there is none.'''
+        if self.ttl <= 0:
+            return Person.get_or_none(Person.uname == uname)
+        now = monotonic()
+        self._check_generation(now)
+        entry = self._entries.get(uname)
+        if entry and entry[0] > now:
+            return entry[1]
+        person = Person.get_or_none(Person.uname == uname)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = {key: value for key, value in self._entries.items()
+                                 if value[0] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[uname] = (now + self.ttl, person)
+        return person
+
+
+    def clear(self):
+        '''Forget everything in the cache.'''
+        with self._lock:
+            self._entries.clear()
+            self._next_check = 0
+
+
+    def _check_generation(self, now):
+        if now < self._next_check:
+            return
+        counter = Counter.get_or_none(Counter.name == _PEOPLE_COUNTER)
+        generation = counter.value if counter else 0
+        with self._lock:
+            if generation != self._generation:
+                if self._generation is not None:
+                    log('people have changed; clearing cache of Person records')
+                self._entries.clear()
+                self._generation = generation
+            self._next_check = now + self.check_interval
+
+
+_PERSON_CACHE = PersonCache(_PERSON_CACHE_SECONDS)
+
+
+def person_named(uname):
+    '''Return the Person with the given uname, or None if there is none.'''
+    return _PERSON_CACHE.get(uname)
+
+
+def people_changed():
+    '''Tell DIBS server processes to discard the Person records they cached.'''
+    (Counter.insert(name = _PEOPLE_COUNTER, value = 1)
+     .on_conflict(conflict_target = [Counter.name],
+                  update = {Counter.value: Counter.value + 1})
+     .execute())
+
+
 def person_from_environ(environ):
     person = None
     if 'REMOTE_USER' in environ:
@@ -70,7 +159,7 @@ def person_from_environ(environ):
         # Either they are a known person (e.g. library staff) or other community
         # member without a role.
         try:
-            person = Person.get_or_none(Person.uname == environ['REMOTE_USER'])
+            person = person_named(environ['REMOTE_USER'])
             if person is None:
                 person = GuestPerson()
                 person.uname = environ['REMOTE_USER']
@@ -149,6 +238,7 @@ class PersonManager:
                 kv[key] = ''
         user = Person(uname = kv['uname'], role = kv['role'], display_name = kv['display_name'])
         user.save()
+        people_changed()
 
     def update_people(self, kv):
         user = Person.select().where(Person.uname == kv['uname']).get()
@@ -165,12 +255,14 @@ class PersonManager:
         if 'role' in kv:
             user.role = kv['role']
         user.save()
+        people_changed()
 
     def remove_people(self, kv):
         if 'uname' not in kv:
             print('WARNING: uname is required')
             sys.exit(1)
         nrows = Person.delete().where(Person.uname == kv['uname']).execute()
+        people_changed()
         if self.htpasswd is not None:
             self._delete_htpasswd(kv['uname'])
         print(f'{nrows} row deleted from person in {self.db_name}')
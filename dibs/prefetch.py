@@ -0,0 +1,103 @@
+'''
+prefetch.py: background fetching of content a viewer is likely to want next
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   concurrent.futures import ThreadPoolExecutor
+import os
+from   sidetrack import log
+import threading
+
+
+# Internal variables.
+# .............................................................................
+
+_pools = {}                             # name -> (pid, ThreadPoolExecutor)
+_pools_lock = threading.Lock()
+
+
+# Exported functions.
+# .............................................................................
+
+def pid_local_pool(name, size):
+    '''Return the pool of "size" threads named "name" for this process.
+
+    Thread pools don't survive a fork, so a new pool is created the first
+    time this is called in a process.  The threads are named after "name".
+    '''
+    with _pools_lock:
+        pid, executor = _pools.get(name, (None, None))
+        if pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers = size, thread_name_prefix = name)
+            _pools[name] = (os.getpid(), executor)
+        return executor
+
+
+# Exported classes.
+# .............................................................................
+
+class Prefetcher():
+    '''Run a function on URLs in the background using a pool of threads.
+
+    "name" is the name of the pool of threads (see pid_local_pool(...)), and
+    the function "fetch" is called as fetch(url, barcode).  At most
+    "max_threads" calls run at the same time, and at most "per_loan" calls
+    can be queued or running for any one value of the "loan" argument given
+    to request(...).  Requests beyond that limit are dropped.
+    '''
+
+    def __init__(self, name, fetch, max_threads, per_loan):
+        self.name = name
+        self.fetch = fetch
+        self.max_threads = max_threads
+        self.per_loan = per_loan
+        self._pending = {}              # loan -> number of pending fetches
+        self._queued = set()            # urls queued or being fetched
+        self._lock = threading.Lock()
+
+
+    def request(self, urls, barcode, loan):
+        '''Fetch "urls" for item "barcode" in the background for "loan".'''
+        for url in urls:
+            with self._lock:
+                if url in self._queued:
+                    continue
+                if self._pending.get(loan, 0) >= self.per_loan:
+                    log(f'prefetch limit reached for {barcode}')
+                    return
+                self._queued.add(url)
+                self._pending[loan] = self._pending.get(loan, 0) + 1
+            self._pool().submit(self._run, url, barcode, loan)
+
+
+    def run(self, function, *args):
+        '''Call function(*args) in the background, using the same threads.'''
+        def call():
+            try:
+                function(*args)
+            except Exception as ex:     # noqa: PIE786
+                log(f'exception in background call of {function.__name__}: ' + str(ex))
+        self._pool().submit(call)
+
+
+    def _pool(self):
+        return pid_local_pool(self.name, self.max_threads)
+
+
+    def _run(self, url, barcode, loan):
+        try:
+            self.fetch(url, barcode)
+        except Exception as ex:         # noqa: PIE786
+            log(f'exception prefetching {url}: ' + str(ex))
+        finally:
+            with self._lock:
+                self._queued.discard(url)
+                self._pending[loan] -= 1
+                if self._pending[loan] <= 0:
+                    del self._pending[loan]
@@ -0,0 +1,85 @@
+'''
+reaper.py: run periodic work when it's due, coordinated among processes
+
+Copyright
+---------
+
+Copyright (c) 2021-2022 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   contextlib import contextmanager
+import fcntl
+import os
+import time
+
+
+# Exported classes.
+# .............................................................................
+
+class Reaper():
+    '''Call "reap" when the due time kept in the file "path" is reached.
+
+    The due time is the modification time of the file, so that all the
+    server processes share it and checking it costs a single stat() call.
+    The work is done while holding an exclusive lock on the file, so that
+    only one process does it.
+
+    The function "reap" is called with no arguments, and must return the
+    next due time (in seconds since the epoch), or None if nothing is
+    pending.  The due time is never set more than "max_wait" seconds ahead,
+    so that changes made behind DIBS's back (e.g., by editing the database)
+    are picked up eventually.
+    '''
+
+    def __init__(self, path, reap, max_wait = 60):
+        self.path = path
+        self.reap = reap
+        self.max_wait = max_wait
+
+
+    def due(self):
+        '''Return the due time, or 0 if it's not known.'''
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return 0
+
+
+    def run_if_due(self):
+        '''Call the function "reap" if the due time has been reached.'''
+        if time.time() < self.due():
+            return
+        with self._locked():
+            # Another process may have done the work while we waited.
+            if time.time() < self.due():
+                return
+            when = self.reap()
+            self._set_due(min(when or float('inf'), time.time() + self.max_wait))
+
+
+    def schedule(self, when):
+        '''Make the due time no later than "when" (in seconds since the epoch).
+
+        This waits for "reap" to finish if another process is running it, so
+        it must not be called while holding a lock that "reap" needs (e.g., in
+        a database transaction).
+        '''
+        with self._locked():
+            if when < self.due():
+                self._set_due(when)
+
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def _set_due(self, when):
+        os.utime(self.path, (when, when))
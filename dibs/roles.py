@@ -11,7 +11,7 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from .data_models import Person
+from .people import person_named
 
 
 _role_table = {
@@ -38,5 +38,5 @@ def staff_user(who):
     '''Return True if the person has admin priviledges in the system.'''
     if isinstance(who, str):
         # Given a user name -- look them up and try to retrieve a Person object.
-        who = Person.get_or_none(Person.uname == who)
+        who = person_named(who)
     return has_role(who, 'library')
@@ -10,36 +10,52 @@ file "LICENSE" for more information.
 '''
 
 import bottle
-from   bottle import Bottle, LocalResponse, static_file, template
-from   bottle import request, response, redirect
+from   bottle import Bottle, HTTPResponse, LocalResponse, static_file, template
+from   bottle import request, response, redirect, parse_date, parse_range_header
+import codecs
 from   commonpy.file_utils import delete_existing
-from   commonpy.network_utils import net
 from   datetime import timedelta as delta
 from   enum import Enum, auto
 from   expiringdict import ExpiringDict
-from   fdsend import send_file
+from   fdsend import format_ts
+from   hashlib import sha256
+import httpx
 from   humanize import naturaldelta, naturalsize
 import inspect
-from   io import BytesIO, StringIO
+from   io import StringIO
 import json
-from   lru import LRU
+import mimetypes
 import os
 from   os.path import realpath, dirname, join, exists
-from   peewee import PeeweeException
+from   peewee import PeeweeException, fn
 from   playhouse.dataset import DataSet
 from   playhouse.reflection import generate_models
 from   sidetrack import log
 from   str2bool import str2bool
 from   textwrap import shorten
+from   threading import BoundedSemaphore
+from   time import monotonic
 from   trinomial import anon
+from   urllib.parse import quote, urlsplit
 
 from . import __version__
+from .caches import DiskCache, IIIFCache, ManifestCache, MemoryCache
+from .compression import compressed, negotiated_encoding, ENCODINGS, MIN_SIZE
+from .context import RequestContext
 from .data_models import database, Item, Loan, History, Person
-from .date_utils import human_datetime, round_minutes, time_now
+from .data_models import set_read_only, writable
+from .date_utils import human_datetime, round_minutes, time_now, timestamp
 from .email import send_email
-from .image_utils import as_jpeg
+from .iiif_utils import adjacent_tile_urls, coarsest_tile_urls, image_request_parts
+from .iiif_utils import manifest_pages, next_service, retiled_info, single_image_manifest
+from .image_utils import as_jpeg, converted, conversion_types, image_type
+from .image_utils import negotiated_image_type
+from .loan_tokens import LoanTokens
 from .lsp import LSP, LSPAccessError, LSPRecordNotFoundError, LSPBadRecordError
-from .people import person_from_environ, GuestPerson
+from .network import Backends, Latencies, hedged, session
+from .people import GuestPerson
+from .prefetch import Prefetcher
+from .reaper import Reaper
 from .roles import staff_user
 from .settings import config, resolved_path
 
@@ -75,6 +91,31 @@ _MAX_THUMBNAIL_SIZE = 1 * 1024 * 1024
 # The base URL of the IIIF server endpoint.
 _IIIF_BASE_URL = config('IIIF_BASE_URL')
 
+# Optionally, requests can be spread over several equivalent IIIF servers
+# (IIIF_BACKENDS is a comma-separated list of base URLs of servers in addition
+# to the one at IIIF_BASE_URL).  URLs are still written in terms of
+# IIIF_BASE_URL, and switched to the base URL of the chosen server when a
+# request is made.
+_IIIF_BACKENDS = Backends(
+    _IIIF_BASE_URL,
+    [url.strip() for url in config('IIIF_BACKENDS', default = '').split(',') if url.strip()],
+    int(config('IIIF_BACKEND_MAX_ERRORS', default = 3)),
+    int(config('IIIF_BACKEND_DOWN_SECONDS', default = 30)))
+
+# If true, a request for an image tile that has not been answered by the time
+# the percentile _IIIF_HEDGE_PERCENTILE of recent response times has passed is
+# sent a second time, and the first response to arrive is used.  The response
+# times are those seen by this process, kept in _IIIF_LATENCY.
+_IIIF_HEDGE = config('IIIF_HEDGE', default = False, cast = bool)
+_IIIF_HEDGE_PERCENTILE = float(config('IIIF_HEDGE_PERCENTILE', default = 95))
+
+# The slower of two hedged requests can't be stopped, and keeps a thread and
+# a connection to the IIIF server busy until it finishes.  At most this many
+# requests in each process are hedged at the same time, so that they can't
+# use up the connection pool when the IIIF server is slow.
+_IIIF_HEDGE_SLOTS = BoundedSemaphore(int(config('IIIF_HEDGE_MAX', default = 4)))
+_IIIF_LATENCY = Latencies()
+
 # Cooling-off period after a loan ends, before user can borrow same title again.
 # Set it to 1 minute in debug mode. (Note: can't check dibs.debug_mode here b/c
 # when this file is loaded, it's not yet set.  Test a Bottle variable instead.)
@@ -98,16 +139,120 @@ _REQUESTS = {'15': ExpiringDict(max_len = 1000000, max_age_seconds = 15*60),
              '45': ExpiringDict(max_len = 1000000, max_age_seconds = 45*60),
              '60': ExpiringDict(max_len = 1000000, max_age_seconds = 60*60)}
 
-# IIIF page cache.  This is a dict where the keys will be IIIF page URLs.
-_IIIF_CACHE = LRU(int(config('IIIF_CACHE_SIZE')))
+# IIIF page cache.  The keys are IIIF page URLs.  There is always a cache in
+# memory, limited in total size and in the share any one barcode can take up;
+# if IIIF_CACHE_DIR is set, it's backed by a disk cache shared by all the
+# server processes.
+_IIIF_CACHE_DIR = resolved_path(config('IIIF_CACHE_DIR', default = ''))
+_IIIF_MEMORY_CACHE = MemoryCache(
+    int(config('IIIF_CACHE_MEMORY_MB', default = 256)) * 1024 * 1024,
+    int(config('IIIF_CACHE_BARCODE_PERCENT', default = 25)) / 100)
+_IIIF_DISK_CACHE = None
+if _IIIF_CACHE_DIR:
+    _IIIF_DISK_CACHE = DiskCache(
+        _IIIF_CACHE_DIR, int(config('IIIF_CACHE_DISK_MB', default = 2048)) * 1024 * 1024)
+_IIIF_CACHE_MAX_AGE = int(config('IIIF_CACHE_MAX_AGE', default = 86400))
+_IIIF_CACHE = IIIFCache(_IIIF_MEMORY_CACHE, _IIIF_DISK_CACHE, _IIIF_CACHE_MAX_AGE)
+
+# Failed requests to the IIIF server are remembered for a short time, during
+# which requests for the same URLs get an error without going to the server.
+# The values are the HTTP status codes to return.
+_IIIF_ERROR_SECONDS = int(config('IIIF_ERROR_CACHE_SECONDS', default = 10))
+_IIIF_FAILURES = ExpiringDict(max_len = 100000, max_age_seconds = _IIIF_ERROR_SECONDS)
+
+# Manifest cache.  Manifests are cached after rewriting their URLs, and reread
+# when the manifest files change.  (The lambda is needed because the function
+# urls_rerouted(...) is only defined further below.)
+_MANIFEST_CACHE = ManifestCache(
+    int(config('MANIFEST_CACHE_MB', default = 64)) * 1024 * 1024,
+    lambda text, barcode: urls_rerouted(text, barcode))
+
+# In the low-bandwidth reading mode, the viewer gets a version of the manifest
+# in which each page is a single image this many pixels wide (made by the IIIF
+# server and cached like other IIIF content).  0 turns the mode off.  The
+# rewritten manifests are cached separately from the originals.
+_LOW_BANDWIDTH_WIDTH = int(config('LOW_BANDWIDTH_WIDTH', default = 1000))
+_LOW_BANDWIDTH_CACHE = ManifestCache(
+    int(config('MANIFEST_CACHE_MB', default = 64)) * 1024 * 1024,
+    lambda text, barcode: low_bandwidth_manifest(text, barcode))
+
+# If true, manifests and IIIF JSON content are sent compressed (using gzip, or
+# Brotli if it's available) to clients that accept it.  Compressed versions are
+# cached, so that the same content is not compressed over and over.
+_COMPRESS_JSON = config('COMPRESS_JSON', default = True, cast = bool)
+
+# Optionally, JPEG images from the IIIF server are converted to other formats
+# (a comma-separated list of "webp" and "avif", in order of preference) for
+# clients that say they accept them.  Converted versions are cached too.
+_IIIF_TRANSCODE = [f'image/{name.strip().lower()}'
+                   for name in config('IIIF_TRANSCODE', default = '').split(',')
+                   if name.strip()]
+if set(_IIIF_TRANSCODE) - set(conversion_types()):
+    log('this version of Pillow cannot write ' + ', '.join(_IIIF_TRANSCODE)
+        + '; only using ' + ', '.join(conversion_types()))
+    _IIIF_TRANSCODE = [t for t in _IIIF_TRANSCODE if t in conversion_types()]
+_IIIF_TRANSCODE_QUALITY = int(config('IIIF_TRANSCODE_QUALITY', default = 80))
+
+# Static files (viewer files, thumbnails, etc.) can be sent by the web server
+# instead of by DIBS.  DIBS still does the routing and any checks, and then
+# tells the server which file to send.  SENDFILE can be "apache" (which uses
+# the X-Sendfile header and needs mod_xsendfile) or "nginx" (which uses the
+# X-Accel-Redirect header with the file path appended to SENDFILE_PREFIX).
+_SENDFILE = config('SENDFILE', default = '').lower()
+_SENDFILE_PREFIX = config('SENDFILE_PREFIX', default = '/sendfile').rstrip('/')
+if _SENDFILE not in ['', 'apache', 'nginx']:
+    raise ValueError(f'Unrecognized value for SENDFILE: {_SENDFILE}')
+
+# If true, content fetched from the IIIF server is passed through to the client
+# as it arrives, instead of being read completely before anything is sent.
+_IIIF_STREAMING = config('IIIF_STREAMING', default = False, cast = bool)
+
+# If not 0, the tile size in IIIF info.json files is increased to about this
+# many pixels, so that viewers make fewer requests for each page.
+_IIIF_TILE_SIZE = int(config('IIIF_TILE_SIZE', default = 0))
+
+# Max amount of JSON text held back while rewriting streamed JSON content.
+_MAX_PENDING_TEXT = 64 * 1024
+
+# If true, fetch content that viewers are likely to request next (such as
+# adjacent image tiles, and the next page) in the background, using a pool of
+# threads, with a limit on the number of pending fetches for any one loan.
+_IIIF_PREFETCH = config('IIIF_PREFETCH', default = False, cast = bool)
+
+# When a loan starts, the IIIF content for the first pages of the item (the
+# info.json files, thumbnails and lowest-resolution tiles) is loaded into the
+# cache in the background.  This is the number of pages; 0 turns it off.
+_LOAN_WARMUP_PAGES = int(config('LOAN_WARMUP_PAGES', default = 5))
+
+# If a secret is configured, the viewer page gives the browser a signed token
+# for the loan in a cookie, and requests for the item's manifest and IIIF
+# content that come with a valid token skip the database.  Tokens of loans
+# that end early are revoked by creating files in _REVOKED_LOANS_DIR.
+_LOAN_TOKEN_SECRET = config('LOAN_TOKEN_SECRET', default = '')
+_REVOKED_LOANS_DIR = resolved_path(config('REVOKED_LOANS_DIR', default = 'data/revoked-loans'))
+_LOAN_TOKENS = (LoanTokens(_LOAN_TOKEN_SECRET, _REVOKED_LOANS_DIR)
+                if _LOAN_TOKEN_SECRET else None)
+
+# If true, the database connection is made read-only while handling GET
+# requests, so that they can only ever read.  (The occasional update of
+# expired loans done while handling a request is still allowed.)
+_DATABASE_READ_ONLY_GET = config('DATABASE_READ_ONLY_GET', default = False, cast = bool)
 
 
 # General-purpose utilities used repeatedly.
 # .............................................................................
 
+def request_context():
+    '''Return the RequestContext for the current request, creating it if needed.'''
+    context = request.environ.get('dibs.context')
+    if context is None:
+        context = request.environ['dibs.context'] = RequestContext(request.environ)
+    return context
+
+
 def page(name, **kargs):
     '''Create a page using template "name" with some standard variables set.'''
-    person = person_from_environ(request.environ)
+    person = request_context().person
     logged_in = (person is not None and person.uname != '')
     if kargs.get('browser_no_cache', False):
         response.add_header('Expires', '0')
@@ -121,7 +266,7 @@ def page(name, **kargs):
         if len(announcement) == 0:
             announcement = None
     return template(name, base_url = dibs.base_url, version = __version__,
-                    logged_in = logged_in, staff_user = staff_user(person),
+                    logged_in = logged_in, staff_user = request_context().staff,
                     announcement = announcement,
                     feedback_url = _FEEDBACK_URL, help_url = _HELP_URL,
                     reloan_wait_time = naturaldelta(_RELOAN_WAIT_TIME), **kargs)
@@ -144,6 +289,10 @@ def debug_mode():
 def urls_rerouted(text, barcode):
     '''Rewrite text to point IIIF URLs to our /iiif endpoint & fix some issues.'''
     barcode = str(barcode)
+    # Content from other IIIF servers may contain their own base URLs.
+    for base in _IIIF_BACKENDS.urls:
+        if base != _IIIF_BASE_URL:
+            text = text.replace(base, _IIIF_BASE_URL)
     rewritten = text.replace(_IIIF_BASE_URL, f'{dibs.base_url}/iiif/{barcode}')
     # Change occurrences of %2F (slashes) in IIIF identifiers to '!' so
     # Apache doesn't auto-convert %2F when UV fetches /iiif/...
@@ -157,6 +306,314 @@ def urls_restored(text, barcode):
     return rewritten.replace(f'{dibs.base_url}/iiif/{barcode}', _IIIF_BASE_URL)
 
 
+def low_bandwidth_manifest(text, barcode):
+    '''Return the text of a manifest rewritten for the low-bandwidth mode.'''
+    manifest = single_image_manifest(json.loads(text), _LOW_BANDWIDTH_WIDTH)
+    return urls_rerouted(json.dumps(manifest), barcode)
+
+
+def urls_rerouted_stream(chunks, barcode):
+    '''Apply urls_rerouted(...) to an iterable of UTF-8 encoded JSON text.'''
+    # In JSON, URLs can only appear inside strings, and none of the patterns
+    # replaced by urls_rerouted(...) contain double quotes.  So it's safe to
+    # rewrite the text up to the last double quote seen so far and carry over
+    # the rest.  Without quotes, hold back only as much text as could contain
+    # the start of a pattern, so that the amount of buffered text is bounded,
+    # and make sure the cut doesn't fall in the middle of a pattern.
+    patterns = _IIIF_BACKENDS.urls + [str(barcode) + r'%2F']
+    holdback = max(len(pattern) for pattern in patterns)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        cut = pending.rfind('"') + 1
+        if cut == 0:
+            if len(pending) < _MAX_PENDING_TEXT:
+                continue
+            cut = cut_outside(pending, len(pending) - holdback, patterns)
+        yield urls_rerouted(pending[:cut], barcode).encode()
+        pending = pending[cut:]
+    pending += decoder.decode(b'', final = True)
+    if pending:
+        yield urls_rerouted(pending, barcode).encode()
+
+
+def cut_outside(text, cut, patterns):
+    '''Return the nearest position <= cut that isn't inside any of patterns.'''
+    moved = True
+    while moved:
+        moved = False
+        for pattern in patterns:
+            # Only an occurrence that spans the cut fits in this window.
+            start = text.find(pattern, max(0, cut - len(pattern) + 1), cut + len(pattern) - 1)
+            if start >= 0:
+                cut, moved = start, True
+    return cut
+
+
+def content_etag(content):
+    '''Return a strong HTTP entity tag for the byte string "content".'''
+    return '"' + sha256(content).hexdigest()[:32] + '"'
+
+
+def file_etag(stat):
+    '''Return a strong HTTP entity tag for a file, given its os.stat() result.'''
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def client_copy_current(etag, mtime = None):
+    '''Return True if the request's conditional headers match etag & mtime.'''
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232 sec. 6).
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and mtime:
+        since = parse_date(if_modified_since.split(';')[0].strip())
+        return since is not None and since >= int(mtime)
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    '''Return True if "etag" is among the tags in an If-None-Match value.'''
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    tags = [(tag[2:] if tag.startswith('W/') else tag) for tag in tags]
+    return '*' in tags or etag in tags
+
+
+def encoded_etag(etag, encoding):
+    '''Return the entity tag for the version of "etag" using "encoding".'''
+    # Each encoding of the same content needs a different entity tag.
+    return etag[:-1] + '-' + encoding + '"'
+
+
+def validator_headers(etag, mtime = None):
+    '''Return a dict of HTTP headers for content that requires a loan.'''
+    # Browsers may keep copies of loaned content, but they must check back
+    # with us before reusing them, so that the loan is checked every time.
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if mtime:
+        headers['Last-Modified'] = format_ts(mtime)
+    return headers
+
+
+def not_modified(etag, mtime = None):
+    '''Return an HTTP 304 (not modified) response.'''
+    log('client has a current copy; returning 304')
+    return HTTPResponse(status = 304, **validator_headers(etag, mtime))
+
+
+def send_content(content, ctype, etag = None, mtime = None, encoding = None):
+    '''Send the byte string "content", or a 304 if the client has it already.
+
+    If "encoding" is given, "content" must be compressed using that encoding.
+    '''
+    etag = etag or content_etag(content)
+    headers = {}
+    if ctype == 'application/json':
+        # JSON content is compressed or not depending on the client.
+        headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        etag = encoded_etag(etag, encoding)
+        headers['Content-Encoding'] = encoding
+    if client_copy_current(etag, mtime):
+        result = not_modified(etag, mtime)
+        headers.pop('Content-Encoding', None)
+    else:
+        result = partial_content(content, ctype, range_requested(etag, mtime))
+        headers.update(validator_headers(etag, mtime))
+    for name, value in headers.items():
+        result.set_header(name, value)
+    return result
+
+
+def partial_content(content, ctype, byte_range = None):
+    '''Return a response with "content", or the part of it in "byte_range".
+
+    The value of "byte_range" is the value of an HTTP Range header.  Requests
+    for more than one range get the whole content.
+    '''
+    size = len(content)
+    headers = {'Content-Type': ctype, 'Accept-Ranges': 'bytes'}
+    ranges = list(parse_range_header(byte_range, size)) if byte_range else []
+    if byte_range and not ranges:
+        return HTTPResponse(status = 416, headers = {'Content-Range': f'bytes */{size}'})
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        headers['Content-Length'] = str(end - start)
+        return HTTPResponse(content[start:end], status = 206, headers = headers)
+    headers['Content-Length'] = str(size)
+    return HTTPResponse(content, status = 200, headers = headers)
+
+
+def range_requested(etag, mtime = None):
+    '''Return the value of the request's Range header, if it should be honored.
+
+    A range is only honored if the request has no If-Range header, or if the
+    If-Range header matches the current entity tag or modification time.
+    '''
+    byte_range = request.environ.get('HTTP_RANGE')
+    if_range = request.environ.get('HTTP_IF_RANGE', '').strip()
+    if not byte_range or not if_range:
+        return byte_range
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only strong entity tags can be used in If-Range (RFC 7233 sec. 3.2).
+        return byte_range if if_range == etag else None
+    return byte_range if mtime and parse_date(if_range) == int(mtime) else None
+
+
+def static_content(filename, root, etag = None):
+    '''Send the file "filename" in directory "root", possibly via the web server.
+
+    If SENDFILE is not set, this uses Bottle's static_file(...), with support
+    for If-Range added.  Otherwise, only the headers are returned, and the
+    web server sends the content of the file.
+    '''
+    root = join(realpath(root), '')
+    path = realpath(join(root, filename.strip('/\\')))
+    if not path.startswith(root) or not os.path.isfile(path):
+        # Let static_file() produce the usual error response.
+        return static_file(filename, root = root)
+    if not _SENDFILE:
+        stat = os.stat(path)
+        etag = etag or file_etag(stat)
+        if request.environ.get('HTTP_RANGE') and not range_requested(etag, stat.st_mtime):
+            # The client's partial copy is out of date, so it must get the
+            # whole file.  (Bottle's static_file() doesn't handle If-Range.)
+            del request.environ['HTTP_RANGE']
+        return static_file(filename, root = root, etag = etag)
+    ctype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if ctype.startswith('text/') or ctype == 'application/javascript':
+        ctype += '; charset=UTF-8'
+    headers = {'Content-Type': ctype}
+    if etag:
+        headers['ETag'] = etag
+    if _SENDFILE == 'apache':
+        headers['X-Sendfile'] = path
+    else:
+        headers['X-Accel-Redirect'] = _SENDFILE_PREFIX + quote(path)
+    return HTTPResponse(status = 200, headers = headers)
+
+
+def preferred_encoding(content, ctype, environ = None):
+    '''Return the encoding to use for sending "content" to the client, or None.
+
+    The Accept-Encoding header is taken from "environ" if given, otherwise
+    from the current Bottle request.
+    '''
+    if not _COMPRESS_JSON or ctype != 'application/json' or len(content) < MIN_SIZE:
+        return None
+    environ = request.environ if environ is None else environ
+    return negotiated_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+
+
+def preferred_image_type(ctype, environ = None):
+    '''Return the image type to convert content of type "ctype" to, or None.
+
+    The Accept header is taken from "environ" if given, otherwise from the
+    current Bottle request.
+    '''
+    if not _IIIF_TRANSCODE or ctype != 'image/jpeg':
+        return None
+    environ = request.environ if environ is None else environ
+    return negotiated_image_type(environ.get('HTTP_ACCEPT'), _IIIF_TRANSCODE)
+
+
+def demote_idle_content(barcodes):
+    '''Demote the cached IIIF content of items that have no active loans.'''
+    for barcode in set(barcodes):
+        if not Loan.select().where(Loan.item == barcode, Loan.state == 'active').exists():
+            log(f'{barcode} has no active loans; demoting its cached content')
+            _IIIF_CACHE.demote(barcode)
+
+
+def expire_loans():
+    '''Update loans that have reached their end or reloan times.
+
+    Returns the POSIX timestamp of the next time a loan will need updating,
+    or None if there are no loans.
+    '''
+    now = time_now()
+    log('checking for expired loans')
+    with writable(), database.atomic('immediate'):
+        # Delete expired loan recency records.
+        n = Loan.delete().where(Loan.state == 'recent', now >= Loan.reloan_time).execute()
+        if n > 0:
+            log(f'deleted {n} recent loans that reached their reloan times')
+        # Change the state of active loans that are past due.
+        due = (Loan.state == 'active') & (now >= Loan.end_time)
+        loans = list(Loan.select(Loan.item, Loan.user, Loan.start_time, Loan.end_time)
+                     .where(due).tuples())
+        if loans:
+            log(f'updating the states of {len(loans)} loans that have ended')
+            # This is round_minutes(end_time + _RELOAN_WAIT_TIME, 'down') in SQL.
+            wait = f'+{int(_RELOAN_WAIT_TIME.total_seconds())} seconds'
+            reloan_time = fn.strftime('%Y-%m-%d %H:%M:00', Loan.end_time, wait)
+            Loan.update(state = 'recent', reloan_time = reloan_time).where(due).execute()
+            # Don't count staff users in stats except in debug mode.
+            history = [{'type': 'loan', 'what': barcode, 'start_time': start, 'end_time': end}
+                       for barcode, uname, start, end in loans
+                       if debug_mode() or not staff_user(uname)]
+            if history:
+                History.insert_many(history).execute()
+        next_end = (Loan.select(Loan.end_time).where(Loan.state == 'active')
+                    .order_by(Loan.end_time).first())
+        next_reloan = (Loan.select(Loan.reloan_time).where(Loan.state == 'recent')
+                       .order_by(Loan.reloan_time).first())
+    demote_idle_content(barcode for barcode, _, _, _ in loans)
+    times = []
+    if next_end:
+        times.append(timestamp(next_end.end_time))
+    if next_reloan:
+        times.append(timestamp(next_reloan.reloan_time))
+    return min(times) if times else None
+
+
+# The next time loans need updating is shared by the server processes using
+# a file next to the database.
+_LOAN_REAPER = Reaper(database.file_path + '-loans-due', expire_loans)
+
+
+def active_loan(barcode, person):
+    '''Return True if person has barcode on loan.
+
+    If the request came with a valid loan token, the database isn't used.
+    '''
+    if request.environ.get('dibs.loan_token') == barcode:
+        return True
+    loan = request_context().loan(barcode, person.uname)
+    return bool(loan and loan.state == 'active')
+
+
+def loan_cookie_name(barcode):
+    '''Return the name of the cookie holding the loan token for barcode.'''
+    return f'dibs-loan-{barcode}'
+
+
+def set_loan_token(loan):
+    '''Give the client a loan token for loan, if loan tokens are in use.'''
+    if not _LOAN_TOKENS:
+        return
+    # (loan.barcode is the item's barcode, without a query to get the item.)
+    barcode = loan.barcode
+    token = _LOAN_TOKENS.issue(loan.user, barcode, loan.end_time)
+    response.set_cookie(loan_cookie_name(barcode), token,
+                        path = urlsplit(dibs.base_url).path or '/',
+                        max_age = max(0, int((loan.end_time - time_now()).total_seconds())),
+                        secure = dibs.base_url.startswith('https'),
+                        httponly = True, samesite = 'lax')
+
+
+def revoke_loan_tokens(loans):
+    '''Revoke the loan tokens of loans that are ending early.'''
+    if not _LOAN_TOKENS:
+        return
+    for loan in loans:
+        log(f'revoking loan token for {loan.barcode} for {user(loan.user)}')
+        _LOAN_TOKENS.revoke(loan.user, loan.barcode, loan.end_time)
+
+
 def user(person):
     if isinstance(person, (Person, GuestPerson)):
         if person.uname:
@@ -188,20 +645,57 @@ class BottlePluginBase():
     api = 2
 
 
+class LoanTokenVerifier(BottlePluginBase):
+    '''Let requests that come with a valid loan token skip the database.
+
+    This only applies to routes given the option "loan_token = True".  If
+    the token is valid, the route function is called directly, without the
+    other plugins, and the route can find out using active_loan(...).
+    '''
+
+    def apply(self, callback, route):
+        if not _LOAN_TOKENS or not route.config.get('loan_token'):
+            return callback
+
+        def loan_token_verifier(*args, **kwargs):
+            uname = request.environ.get('REMOTE_USER')
+            barcode = kwargs['barcode']
+            token = request.get_cookie(loan_cookie_name(barcode))
+            if uname and token and _LOAN_TOKENS.verify(token, uname, barcode):
+                request.environ['dibs.loan_token'] = barcode
+                kwargs['person'] = GuestPerson(uname = uname, display_name = uname)
+                return route.callback(*args, **kwargs)
+            return callback(*args, **kwargs)
+
+        return loan_token_verifier
+
+
 class DatabaseConnector(BottlePluginBase):
-    '''Wrap a route with a connection to the database.'''
+    '''Wrap a route with a connection to the database.
+
+    Each server thread keeps its connection open from one request to the
+    next, so that the connection settings and SQLite's page cache are not
+    thrown away after every request.
+    '''
     def __call__(self, callback):
         def database_connector(*args, **kwargs):
-            log('opening database connection')
-            database.connect()
+            if database.connect(reuse_if_open = True):
+                log('opened database connection')
+            if _DATABASE_READ_ONLY_GET:
+                set_read_only(request.method in ['GET', 'HEAD'])
             try:
                 result = callback(*args, **kwargs)
-                database.commit()
+                # Don't leave anything uncommitted on the open connection.
+                # (Peewee 4 raises an exception if there's nothing to commit.)
+                if database.connection().in_transaction:
+                    database.commit()
             except PeeweeException as ex:
                 log('*** database exception: ' + str(ex))
-            finally:
+                # Start over with a new connection on the next request, and
+                # let Bottle turn the exception into an error page.
                 log('closing database connection')
                 database.close()
+                raise
             return result
 
         return database_connector
@@ -210,38 +704,13 @@ class DatabaseConnector(BottlePluginBase):
 class LoanExpirer(BottlePluginBase):
     '''Wrap every route function with code that expires loans as needed.'''
 
-    # Expiring loans every time any route is invoked is inefficient, but this
-    # approach has the advantage of simplicity in a multi-process Apache server
-    # config.  The alternative would be to implement a separate reaper process,
-    # complicating things significantly.  (If we only had to worry about
-    # multiple threads, it would be easier, but our httpd runs processes.)
+    # Loans only need to be updated when a loan ends or a reloan time is
+    # reached.  _LOAN_REAPER keeps track of the next such time (shared by all
+    # the server processes), so most of the time this does nothing at all.
 
     def __call__(self, callback):
         def loan_expirer(*args, **kwargs):
-            now = time_now()
-            # Delete expired loan recency records.
-            log('checking for expired loans')
-            n = Loan.delete().where(Loan.state == 'recent', now >= Loan.reloan_time).execute()
-            if n > 0:
-                log(f'deleted {n} recent loans that reached their reloan times')
-            # Change the state of active loans that are past due.
-            loans = Loan.select().where(Loan.state == 'active', now >= Loan.end_time)
-            if len(loans) > 0:
-                log('locking db to update loan states')
-                with database.atomic('immediate'):
-                    for loan in loans:
-                        barcode = loan.item.barcode
-                        log(f'updating {barcode} loan state for {user(loan.user)}')
-                        next_time = loan.end_time + _RELOAN_WAIT_TIME
-                        loan.reloan_time = round_minutes(next_time, 'down')
-                        loan.state = 'recent'
-                        loan.save(only = [Loan.state, Loan.reloan_time])
-                        # Don't count staff users in stats except in debug mode
-                        if staff_user(loan.user) and not debug_mode():
-                            continue
-                        History.create(type = 'loan', what = barcode,
-                                       start_time = loan.start_time,
-                                       end_time = loan.end_time)
+            _LOAN_REAPER.run_if_due()
             return callback(*args, **kwargs)
 
         return loan_expirer
@@ -267,7 +736,7 @@ class BarcodeVerifier(BottlePluginBase):
                 barcode = request.POST.barcode.strip()
             elif request.forms.get('barcode', None):
                 barcode = request.forms.get('barcode').strip()
-            if barcode and not Item.get_or_none(Item.barcode == barcode):
+            if barcode and not request_context().item(barcode):
                 log(f'there is no item with barcode {barcode}')
                 return page('error', summary = 'no such barcode',
                             message = f'There is no item with barcode {barcode}.')
@@ -303,6 +772,7 @@ class RouteTracer(BottlePluginBase):
 # Hook in the plugins above into all routes. The order here matters: the first
 # one added here becomes the first one called.
 
+dibs.install(LoanTokenVerifier())
 dibs.install(DatabaseConnector())
 dibs.install(RouteTracer())
 dibs.install(BarcodeVerifier())
@@ -316,7 +786,7 @@ class AddPersonArgument(BottlePluginBase):
     '''Inject a 'person' keyword to the arguments of a route function.'''
     def apply(self, callback, route):
         def person_plugin_wrapper(*args, **kwargs):
-            person = person_from_environ(request.environ)
+            person = request_context().person
             if person is None or person.uname is None:
                 log('person is None')
                 return page('error', summary = 'authentication failure',
@@ -331,12 +801,12 @@ class VerifyStaffUser(BottlePluginBase):
     '''Redirect to an error page if the user lacks sufficient priviledges.'''
     def apply(self, callback, route):
         def staff_person_plugin_wrapper(*args, **kwargs):
-            person = person_from_environ(request.environ)
+            person = request_context().person
             if person is None:
                 log('person is None')
                 return page('error', summary = 'authentication failure',
                             message = 'Unrecognized user identity.')
-            if not staff_user(person):
+            if not request_context().staff:
                 log(f'{request.path} invoked by non-staff {user(person)}')
                 redirect(f'{dibs.base_url}/notallowed')
                 return
@@ -545,7 +1015,9 @@ def toggle_ready():
         # If we are removing readiness, we may have to close outstanding
         # loans.  Doesn't matter if these are active or recent loans.
         if not item.ready:
-            for loan in Loan.select().where(Loan.item == item):
+            loans = list(Loan.select().where(Loan.item == item))
+            revoke_loan_tokens(loan for loan in loans if loan.state == 'active')
+            for loan in loans:
                 # Don't count staff users in loan stats except in debug mode.
                 if staff_user(loan.user) and not debug_mode():
                     continue
@@ -555,6 +1027,8 @@ def toggle_ready():
             n = Loan.delete().where(Loan.item == item).execute()
             if n > 0:
                 log(f'deleted {n} loans for {barcode}')
+    if not item.ready:
+        demote_idle_content([barcode])
     redirect(f'{dibs.base_url}/list')
 
 
@@ -567,9 +1041,11 @@ def remove_item():
     with database.atomic('immediate'):
         item.ready = False
         item.save(only = [Item.ready])
+        revoke_loan_tokens(Loan.select().where(Loan.item == item, Loan.state == 'active'))
         Loan.delete().where(Loan.item == item).execute()
         # Note we don't create History for items that will no longer exist.
         Item.delete().where(Item.barcode == barcode).execute()
+    _IIIF_CACHE.purge(barcode)
     redirect(f'{dibs.base_url}/manage')
 
 
@@ -644,7 +1120,7 @@ class Status(Enum):
 def loan_availability(user, barcode):
     '''Return multiple values: (item, status, explanation, when_available).'''
 
-    item = Item.get_or_none(Item.barcode == barcode)
+    item = request_context().item(barcode)
     if not item:
         log(f'unknown barcode {barcode}')
         status = Status.UNKNOWN_ITEM
@@ -659,7 +1135,7 @@ def loan_availability(user, barcode):
     # Start by checking if the user has any active or recent loans.
     explanation = ''
     when_available = None
-    loan = Loan.get_or_none(Loan.user == user, Loan.item == item)
+    loan = request_context().loan(barcode, user)
     who = anon(user)
     if loan:
         if loan.state == 'active':
@@ -744,6 +1220,8 @@ def loan_item(person):
     # that two users don't do them concurrently, or else we might make 2 loans.
     log('locking db')
     with database.atomic('immediate'):
+        # Items and loans looked up before we had the lock may have changed.
+        request_context().reload()
         item, status, explanation, when_available = loan_availability(person.uname, barcode)
         if status == Status.NOT_READY:
             # Normally we shouldn't see a loan request through this form if the
@@ -787,6 +1265,12 @@ def loan_item(person):
         Loan.create(item = item, state = 'active', user = person.uname,
                     start_time = start, end_time = end, reloan_time = reloan)
 
+    # The reaper's lock is held while it updates the database, so it must not
+    # be taken while holding the database lock.
+    _LOAN_REAPER.schedule(timestamp(end))
+    _IIIF_CACHE.promote(barcode)
+    if _LOAN_WARMUP_PAGES > 0:
+        warm_iiif_cache(barcode, person)
     send_email(person.uname, item, start, end, dibs.base_url)
     log(f'redirecting {user(person)} to viewer page for new loan on {barcode}')
     redirect(f'{dibs.base_url}/view/{barcode}')
@@ -809,22 +1293,26 @@ def end_loan(barcode, person):
     else:
         barcode = post_barcode
 
-    item = Item.get(Item.barcode == barcode)
-    loan = Loan.get_or_none(Loan.item == item, Loan.user == person.uname)
+    loan = request_context().loan(barcode, person.uname)
     if loan and loan.state == 'active':
         # Normal case: user has loaned a copy of item. Update to 'recent'.
         log(f'locking db to change {barcode} loan state by user {user(person)}')
         with database.atomic('immediate'):
+            # The token is for the original end time, so revoke it first.
+            revoke_loan_tokens([loan])
             now = time_now()
             loan.state = 'recent'
             loan.end_time = now
             loan.reloan_time = round_minutes(now + _RELOAN_WAIT_TIME, 'down')
             loan.save(only = [Loan.state, Loan.end_time, Loan.reloan_time])
-            if not staff_user(loan.user) or debug_mode():
+            if not request_context().staff or debug_mode():
                 # Don't count staff users in loan stats except in debug mode.
-                History.create(type = 'loan', what = loan.item.barcode,
+                History.create(type = 'loan', what = barcode,
                                start_time = loan.start_time,
                                end_time = loan.end_time)
+        # As in loan_item(), this must be done outside the transaction.
+        _LOAN_REAPER.schedule(timestamp(loan.reloan_time))
+        demote_idle_content([barcode])
         redirect(f'{dibs.base_url}/thankyou')
     else:
         log(f'{user(person)} does not have {barcode} loaned out')
@@ -834,12 +1322,16 @@ def end_loan(barcode, person):
 @dibs.get('/view/<barcode>', apply = AddPersonArgument())
 def send_item_to_viewer(barcode, person):
     '''Redirect to the viewer.'''
-    item = Item.get(Item.barcode == barcode)
-    loan = Loan.get_or_none(Loan.item == item, Loan.user == person.uname)
+    item = request_context().item(barcode)
+    loan = request_context().loan(barcode, person.uname)
     if loan and loan.state == 'active':
         log(f'redirecting to viewer for {barcode} for {user(person)}')
         wait_time = _RELOAN_WAIT_TIME
+        set_loan_token(loan)
+        low_bandwidth = bool(_LOW_BANDWIDTH_WIDTH) and request.query.mode == 'lite'
         return page('uv', browser_no_cache = True, barcode = barcode,
+                    low_bandwidth = low_bandwidth,
+                    low_bandwidth_available = bool(_LOW_BANDWIDTH_WIDTH),
                     title = shorten(item.title, width = 100, placeholder = ' …'),
                     end_time = human_datetime(loan.end_time, '%I:%M %p (%b %d, %Z)'),
                     js_end_time = human_datetime(loan.end_time, '%m/%d/%Y %H:%M:%S'),
@@ -849,67 +1341,420 @@ def send_item_to_viewer(barcode, person):
         redirect(f'{dibs.base_url}/item/{barcode}')
 
 
-@dibs.get('/manifests/<barcode>', apply = AddPersonArgument())
+@dibs.get('/manifests/<barcode>', apply = AddPersonArgument(), loan_token = True)
 def return_iiif_manifest(barcode, person):
     '''Return the manifest file for a given item.'''
-    item = Item.get(Item.barcode == barcode)
-    loan = Loan.get_or_none(Loan.item == item, Loan.user == person.uname)
-    if loan and loan.state == 'active':
+    return manifest_content(barcode, person, _MANIFEST_CACHE)
+
+
+@dibs.get('/manifests/<barcode>/lite', apply = AddPersonArgument(), loan_token = True)
+def return_low_bandwidth_manifest(barcode, person):
+    '''Return the manifest for the low-bandwidth reading mode.'''
+    if not _LOW_BANDWIDTH_WIDTH:
+        bottle.abort(404, 'Low-bandwidth mode is not available.')
+    return manifest_content(barcode, person, _LOW_BANDWIDTH_CACHE)
+
+
+def manifest_content(barcode, person, cache):
+    '''Return the manifest for barcode from cache, if person has a loan.'''
+    if active_loan(barcode, person):
         manifest_file = join(_MANIFEST_DIR, f'{barcode}-manifest.json')
-        if not exists(manifest_file):
+        manifest = cache.get(manifest_file, barcode)
+        if not manifest:
             log(f'{manifest_file} does not exist')
             return
         record_request(barcode)
-        with open(manifest_file, 'r', encoding = 'utf-8') as mf:
-            adjusted_content = urls_rerouted(mf.read(), barcode)
-            encoded_content = adjusted_content.encode()
-            data = BytesIO(encoded_content)
-            size = len(encoded_content)
-            log(f'returning manifest for {barcode} for {user(person)}')
-            return send_file(data, ctype = 'application/json', size = size)
+        content, stat = manifest
+        encoding = preferred_encoding(content, 'application/json')
+        if encoding:
+            content, stat = cache.get(manifest_file, barcode, encoding) or manifest
+        log(f'returning manifest for {barcode} for {user(person)}')
+        return send_content(content, 'application/json',
+                            file_etag(stat), stat.st_mtime, encoding)
     else:
         log(f'{user(person)} does not have {barcode} loaned out')
         redirect(f'{dibs.base_url}/notallowed')
         return
 
 
-@dibs.get('/iiif/<barcode>/<rest:re:.+>', apply = AddPersonArgument())
+@dibs.get('/iiif/<barcode>/<rest:re:.+>', apply = AddPersonArgument(), loan_token = True)
 def return_iiif_content(barcode, rest, person):
     '''Return the manifest file for a given item.'''
-    item = Item.get(Item.barcode == barcode)
-    loan = Loan.get_or_none(Loan.item == item, Loan.user == person.uname)
-    if loan and loan.state == 'active':
+    if active_loan(barcode, person):
         record_request(barcode)
         url = _IIIF_BASE_URL + '/' + urls_restored(rest, barcode)
-        if url in _IIIF_CACHE:
-            content, ctype = _IIIF_CACHE[url]
-            data = BytesIO(content)
-            log(f'returning cached /iiif/{barcode}/{rest} for {user(person)}')
-            return send_file(data, ctype = ctype, size = len(content))
-
-        # Read the data from our IIIF server instance & send it to the client.
-        log(f'getting /iiif/{barcode}/{rest} from server')
-        response, error = net('get', url)
-        if not error:
-            if url.endswith('json'):
-                # Always rewrite URLs in any JSON files we send to the client.
-                content = urls_rerouted(response.text, barcode).encode()
-                ctype = 'application/json'
-            else:
-                content = response.content
-                ctype = 'image/jpeg'
-            _IIIF_CACHE[url] = (content, ctype)
-            data = BytesIO(content)
+        # If someone else is already fetching this url, wait for them.
+        uncached = (url not in _IIIF_FAILURES and url not in _IIIF_CACHE
+                    and not _IIIF_CACHE.loading(url))
+        # If the client asks for part of an image we don't have, ask the IIIF
+        # server for that part.  (If-Range needs the whole content to check.)
+        if (uncached and request.environ.get('HTTP_RANGE') and not url.endswith('json')
+                and not request.environ.get('HTTP_IF_RANGE')):
+            return ranged_iiif_content(url, barcode, rest, person)
+        # (info.json files can't be streamed if their tile sizes are changed.)
+        if _IIIF_STREAMING and uncached and not (_IIIF_TILE_SIZE and is_info(url)):
+            # Other requests for the url made meanwhile wait for the result.
+            # (If another request got here first, wait for it below instead.)
+            finish = _IIIF_CACHE.start_loading(url)
+            if finish:
+                if _IIIF_PREFETCH:
+                    prefetch_iiif_content(url, barcode, person)
+                return streamed_iiif_content(url, barcode, rest, person, finish)
+
+        # Get the data from our cache or IIIF server & send it to the client.
+        result = iiif_content(url, barcode)
+        if _IIIF_PREFETCH:
+            prefetch_iiif_content(url, barcode, person)
+        if result:
+            content, ctype = result
+            encoding = preferred_encoding(content, ctype)
+            if encoding:
+                content = encoded_iiif_content(url, barcode, content, encoding)
+            # Images may be sent in different formats depending on the client.
+            vary = bool(_IIIF_TRANSCODE) and ctype == 'image/jpeg'
+            new_type = preferred_image_type(ctype)
+            if new_type:
+                content, ctype = transcoded_iiif_content(url, barcode, content, new_type)
             log(f'returning content of /iiif/{barcode}/{rest} for {user(person)}')
-            return send_file(data, ctype = ctype, size = len(content))
+            result = send_content(content, ctype, encoding = encoding)
+            if vary:
+                result.set_header('Vary', 'Accept')
+            return result
         else:
-            log(f'error {str(error)} accessing {url}')
-            return
+            return iiif_error(url)
     else:
         log(f'{user(person)} does not have {barcode} loaned out')
         redirect(f'{dibs.base_url}/notallowed')
 
 
+def iiif_content(url, barcode):
+    '''Return (content, ctype) for url, from the cache or the IIIF server.'''
+    if url in _IIIF_FAILURES:
+        # Don't go back to the IIIF server yet, but use a cached copy if any.
+        return _IIIF_CACHE.get(url, barcode)
+    # Concurrent requests for the same url result in only one upstream fetch.
+    return _IIIF_CACHE.load(url, barcode, lambda: fetched_iiif_content(url, barcode))
+
+
+def iiif_error(url):
+    '''Return an HTTP error response for a failed request for url.'''
+    status, headers = iiif_error_status(url)
+    return HTTPResponse(status = status, headers = headers)
+
+
+def iiif_error_status(url):
+    '''Return (status, headers) for an error response for a request for url.'''
+    status = _IIIF_FAILURES.get(url, 502)
+    headers = {'Cache-Control': 'no-store'}
+    if status != 404:
+        # Tell clients when it's worth trying again.
+        headers['Retry-After'] = str(max(1, _IIIF_ERROR_SECONDS))
+    return status, headers
+
+
+def upstream_get(url, headers = None, stream = False):
+    '''Send a GET request for the IIIF url to one of the IIIF servers.
+
+    The server is chosen by _IIIF_BACKENDS.  If the request fails because of
+    a problem with the server or the network, it's tried on the other servers
+    in turn.  Returns a tuple (response, error), where "error" is None or the
+    exception raised.  If "stream" is True, the caller must close the response.
+    '''
+    client = session()
+    tried = []
+    while True:
+        base = _IIIF_BACKENDS.choose(exclude = tried)
+        if tried:
+            log(f'retrying {url} using {base}')
+        tried.append(base)
+        upstream_request = client.build_request('GET', _IIIF_BACKENDS.url_for(url, base),
+                                                headers = headers)
+        response, error = None, None
+        start = monotonic()
+        _IIIF_BACKENDS.started(base)
+        try:
+            response = client.send(upstream_request, stream = stream)
+        except httpx.HTTPError as ex:
+            error = ex
+        ok = upstream_succeeded((response, error))
+        elapsed = monotonic() - start
+        _IIIF_BACKENDS.finished(base, elapsed, ok)
+        if ok and not stream and _IIIF_HEDGE and image_request_parts(url):
+            _IIIF_LATENCY.add(elapsed)
+        if ok or len(tried) == len(_IIIF_BACKENDS.urls):
+            return response, error
+        if response is not None:
+            response.close()
+
+
+def upstream_succeeded(result):
+    '''Return True unless the (response, error) result shows a server problem.'''
+    response, error = result
+    return error is None and response.status_code < 500
+
+
+def upstream_status(response, error):
+    '''Return the HTTP status code to report for a failed upstream request.'''
+    if isinstance(error, httpx.TimeoutException):
+        return 504
+    if response is not None and response.status_code in [404, 410]:
+        return 404
+    return 502
+
+
+def encoded_iiif_content(url, barcode, content, encoding):
+    '''Return "content" (from "url") compressed using "encoding".'''
+    # Compressed versions are cached under the url plus the encoding.
+    key = url + '#' + encoding
+    result = _IIIF_CACHE.load(key, barcode, lambda: (compressed(content, encoding),
+                                                     'application/json'))
+    return result[0]
+
+
+def transcoded_iiif_content(url, barcode, content, new_type):
+    '''Return (content, ctype) for the version of url using new_type.
+
+    If the converted image would be larger than the original, the original
+    is returned (and cached as the converted version).
+    '''
+    def convert():
+        log(f'converting {url} to {new_type}')
+        try:
+            new_content = converted(content, new_type, _IIIF_TRANSCODE_QUALITY)
+        except (OSError, ValueError) as ex:
+            log(f'unable to convert {url} to {new_type}: ' + str(ex))
+            return content, 'image/jpeg'
+        if len(new_content) >= len(content):
+            return content, 'image/jpeg'
+        return new_content, new_type
+    # Converted versions are cached under the url plus the image type.
+    return _IIIF_CACHE.load(url + '#' + new_type, barcode, convert)
+
+
+def upstream_ctype(response, content = None):
+    '''Return the MIME type of the image in a response from the IIIF server.'''
+    # Trust the image data over the Content-Type header, and the header over
+    # the file extension of the request.
+    ctype = image_type(content) if content else None
+    header = response.headers.get('content-type', '').split(';')[0].strip().lower()
+    return ctype or (header if header.startswith('image/') else 'image/jpeg')
+
+
+def fetched_iiif_content(url, barcode):
+    '''Get the content at url from the IIIF server & return (content, ctype).'''
+    log(f'getting {url} from server')
+    response, error = hedged_upstream_get(url)
+    if error or response.status_code != 200:
+        log(f'error {str(error or response.status_code)} accessing {url}')
+        _IIIF_FAILURES[url] = upstream_status(response, error)
+        return None
+    if url.endswith('json'):
+        content = rewritten_json(url, response.text, barcode)
+        ctype = 'application/json'
+    else:
+        content = response.content
+        ctype = upstream_ctype(response, content)
+    return content, ctype
+
+
+def rewritten_json(url, text, barcode):
+    '''Return the JSON text from url, as rewritten for the client, in UTF-8.'''
+    # Always rewrite URLs in any JSON files we send to the client.
+    text = urls_rerouted(text, barcode)
+    if _IIIF_TILE_SIZE and is_info(url):
+        try:
+            info = json.loads(text)
+        except ValueError:
+            log(f'unable to parse {url}')
+            return text.encode()
+        new_info = retiled_info(info, _IIIF_TILE_SIZE)
+        if new_info is not info:
+            log(f'changing tile size in {url}')
+            text = json.dumps(new_info)
+    return text.encode()
+
+
+def is_info(url):
+    '''Return True if url is for the info.json file of an image service.'''
+    return url.endswith('/info.json')
+
+
+def hedged_upstream_get(url):
+    '''Like upstream_get(url), but make a second request if the first is slow.
+
+    Only requests for image tiles are hedged, and only if IIIF_HEDGE is set.
+    '''
+    if not _IIIF_HEDGE or not image_request_parts(url):
+        return upstream_get(url)
+    delay = _IIIF_LATENCY.percentile(_IIIF_HEDGE_PERCENTILE)
+    return hedged(lambda: upstream_get(url), delay, upstream_succeeded, _IIIF_HEDGE_SLOTS)
+
+
+def prefetch_iiif_content(url, barcode, person):
+    '''Start fetching content the viewer is likely to ask for after url.'''
+    parts = image_request_parts(url)
+    if not parts:
+        return
+    service = parts[0]
+    urls = []
+    info = _IIIF_CACHE.get(service + '/info.json', barcode)
+    if info:
+        urls += adjacent_tile_urls(url, json.loads(info[0]))
+    manifest_file = join(_MANIFEST_DIR, f'{barcode}-manifest.json')
+    next_page = next_service(service, manifest_file)
+    if next_page:
+        urls += [next_page + '/info.json', '/'.join([next_page, *parts[1:]])]
+    urls = [u for u in urls if u not in _IIIF_CACHE]
+    if urls:
+        _PREFETCHER.request(urls, barcode, (barcode, person.uname))
+
+
+def revalidate_iiif_content(key, barcode):
+    '''Arrange for the stale cached content for key to be refreshed.'''
+    # Compressed & converted versions are removed when the original is refreshed.
+    if '#' not in key:
+        _REVALIDATOR.request([key], barcode, barcode)
+
+
+def revalidated_iiif_content(url, barcode):
+    '''Refresh the cached content for url from the IIIF server.'''
+    if url in _IIIF_FAILURES:
+        return
+    log(f'revalidating stale cached content for {url}')
+    if _IIIF_CACHE.refresh(url, barcode, lambda: fetched_iiif_content(url, barcode)):
+        for variant in ENCODINGS + _IIIF_TRANSCODE:
+            _IIIF_CACHE.remove(url + '#' + variant)
+
+
+# Stale content is refreshed by a small pool of background threads, while the
+# stale content continues to be served.
+_REVALIDATOR = Prefetcher('revalidate', revalidated_iiif_content, 2, 16)
+_IIIF_CACHE.revalidate = revalidate_iiif_content
+
+
+# Prefetching is done by the following pool of background threads.
+_PREFETCHER = Prefetcher('prefetch', iiif_content,
+                         int(config('IIIF_PREFETCH_THREADS', default = 4)),
+                         int(config('IIIF_PREFETCH_PER_LOAN', default = 8)))
+
+
+def warm_iiif_cache(barcode, person):
+    '''Start loading the first pages of an item into the IIIF cache.'''
+    # Manifests can be large, so even reading one is done in the background.
+    _WARMER.run(queue_warmup, barcode, person.uname)
+
+
+def queue_warmup(barcode, uname):
+    '''Queue the first pages of an item for loading into the IIIF cache.'''
+    manifest_file = join(_MANIFEST_DIR, f'{barcode}-manifest.json')
+    pages = manifest_pages(manifest_file)[:_LOAN_WARMUP_PAGES]
+    urls = [service + '/info.json' for service, _ in pages]
+    # Thumbnails on other servers don't go through us, so skip those.
+    urls += [thumbnail for _, thumbnail in pages
+             if thumbnail and thumbnail.startswith(_IIIF_BASE_URL + '/')]
+    log(f'warming IIIF cache with {len(pages)} pages of {barcode}')
+    _WARMER.request(urls, barcode, (barcode, uname))
+
+
+def warmed_iiif_content(url, barcode):
+    '''Load url into the IIIF cache, plus the first tiles if it's an info.json.'''
+    result = iiif_content(url, barcode)
+    if result and is_info(url):
+        service = url[:-len('/info.json')]
+        for tile_url in coarsest_tile_urls(service, json.loads(result[0])):
+            iiif_content(tile_url, barcode)
+
+
+# Loan-start warming is done by another pool of threads, so that it doesn't
+# hold up or get held up by prefetching for loans already in progress.
+_WARMER = Prefetcher('warmup', warmed_iiif_content,
+                     int(config('LOAN_WARMUP_THREADS', default = 4)),
+                     2 * _LOAN_WARMUP_PAGES)
+
+
+def ranged_iiif_content(url, barcode, rest, person):
+    '''Pass the client's range request for url on to the IIIF server.'''
+    log(f'forwarding range request for /iiif/{barcode}/{rest} to server')
+    upstream, error = upstream_get(url, headers = {'Range': request.environ['HTTP_RANGE']})
+    if error:
+        log(f'error {str(error)} accessing {url}')
+        _IIIF_FAILURES[url] = upstream_status(None, error)
+        return iiif_error(url)
+    if upstream.status_code == 200:
+        # The server sent the whole thing anyway, so cache it & send the part.
+        ctype = upstream_ctype(upstream, upstream.content)
+        _IIIF_CACHE.put(url, upstream.content, ctype, barcode)
+        return send_content(upstream.content, ctype)
+    if upstream.status_code in [206, 416]:
+        headers = {'Content-Range': upstream.headers.get('content-range', ''),
+                   'Cache-Control': 'private, no-cache'}
+        if upstream.status_code == 206:
+            headers['Content-Type'] = upstream_ctype(upstream)
+        log(f'returning part of /iiif/{barcode}/{rest} for {user(person)}')
+        return HTTPResponse(upstream.content, status = upstream.status_code,
+                            headers = headers)
+    log(f'error code {upstream.status_code} accessing {url}')
+    _IIIF_FAILURES[url] = upstream_status(upstream, None)
+    return iiif_error(url)
+
+
+def streamed_iiif_content(url, barcode, rest, person, finish):
+    '''Pass the content at "url" through to the client as it arrives.
+
+    "finish" is the function returned by _IIIF_CACHE.start_loading(url), and
+    is called when done so that other requests for url can proceed.
+    '''
+    log(f'streaming /iiif/{barcode}/{rest} from server')
+    try:
+        upstream, error = upstream_get(url, stream = True)
+    except Exception:                   # noqa: PIE786
+        finish(abandoned = True)
+        raise
+    if error:
+        log(f'error {str(error)} accessing {url}')
+        _IIIF_FAILURES[url] = upstream_status(None, error)
+        finish(None)
+        return iiif_error(url)
+    if upstream.status_code != 200:
+        log(f'error code {upstream.status_code} accessing {url}')
+        upstream.close()
+        _IIIF_FAILURES[url] = upstream_status(upstream, None)
+        finish(None)
+        return iiif_error(url)
+
+    if url.endswith('json'):
+        ctype = 'application/json'
+        body = urls_rerouted_stream(upstream.iter_bytes(), barcode)
+    else:
+        ctype = upstream_ctype(upstream)
+        body = upstream.iter_bytes()
+        # iter_bytes() undoes any Content-Encoding, which changes the length.
+        if 'content-length' in upstream.headers and 'content-encoding' not in upstream.headers:
+            response.set_header('Content-Length', upstream.headers['content-length'])
+    response.content_type = ctype
+
+    def content_stream():
+        # Keep a copy of what we send, and cache it only if we got all of it.
+        # If we didn't (e.g., because the client went away), the requests
+        # waiting for this one have to get the content themselves.
+        parts = []
+        try:
+            for chunk in body:
+                parts.append(chunk)
+                yield chunk
+            content = b''.join(parts)
+            _IIIF_CACHE.put(url, content, ctype, barcode)
+            finish((content, ctype))
+            log(f'returned content of /iiif/{barcode}/{rest} for {user(person)}')
+        except httpx.HTTPError as ex:
+            log(f'error {str(ex)} while streaming {url}')
+        finally:
+            finish(abandoned = True)    # Does nothing if already finished.
+            upstream.close()
+
+    return content_stream()
+
+
 # Universal viewer interface.
 # .............................................................................
 # The uv subdirectory contains generic html and css.  We serve them as static
@@ -925,14 +1770,14 @@ _UNNECESSARY_PLUGINS = [
 @dibs.route('/viewer/uv/<filepath:path>', skip = _UNNECESSARY_PLUGINS)
 def serve_uv_files(filepath):
     log(f'serving static uv file /viewer/uv/{filepath}')
-    return static_file(filepath, root = 'viewer/uv')
+    return static_content(filepath, root = 'viewer/uv')
 
 
 @dibs.route('/view/img/<filepath:path>', skip = _UNNECESSARY_PLUGINS)
 @dibs.route('/viewer/img/<filepath:path>', skip = _UNNECESSARY_PLUGINS)
 def serve_uv_img_files(filepath):
     log(f'serving static uv file /viewer/img/{filepath}')
-    return static_file(filepath, root = 'viewer/img')
+    return static_content(filepath, root = 'viewer/img')
 
 
 @dibs.route('/view/lib/<filepath:path>', skip = _UNNECESSARY_PLUGINS)
@@ -942,10 +1787,10 @@ def serve_uv_lib_files(filepath):
     # Otherwise, return the requested file.
     if filepath.endswith('.config.json'):
         log('serving file /dibs/static/uv-config.json')
-        return static_file('uv-config.json', root = 'dibs/static')
+        return static_content('uv-config.json', root = 'dibs/static')
     else:
         log(f'serving static uv file /viewer/lib/{filepath}')
-        return static_file(filepath, root = 'viewer/lib')
+        return static_content(filepath, root = 'viewer/lib')
 
 
 @dibs.route('/view/themes/<filepath:path>', skip = _UNNECESSARY_PLUGINS)
@@ -955,13 +1800,13 @@ def serve_uv_themes_files(filepath):
     if filepath.startswith('undefined'):
         filepath = filepath.replace('undefined', 'uv-en-gb-theme')
     log(f'serving static uv file /viewer/themes/{filepath}')
-    return static_file(filepath, root = 'viewer/themes')
+    return static_content(filepath, root = 'viewer/themes')
 
 
 @dibs.route('/viewer/<filepath:path>', skip = _UNNECESSARY_PLUGINS)
 def serve_viewer_files(filepath):
     log(f'serving static uv file /viewer/{filepath}')
-    return static_file(filepath, root = 'viewer')
+    return static_content(filepath, root = 'viewer')
 
 
 # Error pages.
@@ -1004,14 +1849,21 @@ def error500(error):
 @dibs.get('/favicon.ico', skip = _UNNECESSARY_PLUGINS)
 def favicon():
     '''Return the favicon.'''
-    return static_file('favicon.ico', root = 'dibs/static')
+    return static_content('favicon.ico', root = 'dibs/static')
 
 
 @dibs.get('/thumbnails/<filename:re:[0-9]+.jpg>', skip = _UNNECESSARY_PLUGINS)
 def thumbnail_file(filename):
     '''Return a thumbnail image file.'''
     log(f'returning included file {filename}')
-    return static_file(filename, root = _THUMBNAILS_DIR)
+    try:
+        etag = file_etag(os.stat(join(_THUMBNAILS_DIR, filename)))
+    except OSError:
+        # Let static_content() produce the usual error response.
+        etag = None
+    if etag and client_copy_current(etag):
+        return HTTPResponse(status = 304, ETag = etag)
+    return static_content(filename, root = _THUMBNAILS_DIR, etag = etag)
 
 
 @dibs.get('/static/<filename:re:[-a-zA-Z0-9]+.(html|jpg|svg|css|js|json)>',
@@ -1019,4 +1871,4 @@ def thumbnail_file(filename):
 def included_file(filename):
     '''Return a static file used with %include in a template.'''
     log(f'returning included file {filename}')
-    return static_file(filename, root = 'dibs/static')
+    return static_content(filename, root = 'dibs/static')
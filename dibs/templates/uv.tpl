@@ -90,6 +90,22 @@
      return infoElement;
    }
 
+   function viewModeLink () {
+     const linkElement = document.createElement('div');
+     linkElement.setAttribute('id', 'view-mode');
+     %if low_bandwidth:
+     const html = '<a href="{{base_url}}/view/{{barcode}}"'
+                + ' title="Show pages as zoomable high-resolution images">'
+                + 'Full-resolution view</a>';
+     %else:
+     const html = '<a href="{{base_url}}/view/{{barcode}}?mode=lite"'
+                + ' title="Show each page as a single image, for slow connections">'
+                + 'Low-bandwidth view</a>';
+     %end
+     linkElement.innerHTML = html;
+     return linkElement;
+   }
+
    function endLoanButton (id) {
      const buttonElement = document.createElement('div');
      buttonElement.setAttribute('id', id);
@@ -121,7 +137,11 @@
 
      dibsUV = createUV('#uv', {
        root            : '.',
+       %if low_bandwidth:
+       iiifResourceUri : '{{base_url}}/manifests/{{barcode}}/lite',
+       %else:
        iiifResourceUri : '{{base_url}}/manifests/{{barcode}}',
+       %end
        configUri       : '{{base_url}}/static/uv-config.json',
        collectionIndex : Number(urlDataProvider.get('c', 0)),
        sequenceIndex   : Number(urlDataProvider.get('s', 0)),
@@ -136,6 +156,9 @@
        let uvOptions = document.getElementsByClassName('options');
        let uvTop = uvOptions[0];
        uvTop.insertBefore(expirationTimeInfo(), uvTop.firstChild);
+       %if low_bandwidth_available:
+       uvTop.insertBefore(viewModeLink(), uvTop.firstChild.nextSibling);
+       %end
 
        let rightOptions = document.getElementsByClassName('rightOptions');
        let rightDiv = rightOptions[0];
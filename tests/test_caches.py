@@ -0,0 +1,214 @@
+def test_disk_cache(tmp_path):
+    from dibs.caches import DiskCache
+
+    cache = DiskCache(str(tmp_path), 100)
+    assert cache.get('a') is None
+    cache.put('a', b'x' * 40, 'image/jpeg')
+    assert 'a' in cache
+    assert cache.get('a') == (b'x' * 40, 'image/jpeg')
+    # Same content under a different key is only stored once.
+    cache.put('b', b'x' * 40, 'image/jpeg')
+    assert cache.size() == 40
+    cache.remove('a')
+    assert 'a' not in cache
+    assert cache.get('b') == (b'x' * 40, 'image/jpeg')
+
+
+def test_disk_cache_eviction(tmp_path):
+    from dibs.caches import DiskCache
+
+    cache = DiskCache(str(tmp_path), 100)
+    cache.put('a', b'a' * 60, 'image/jpeg')
+    cache.put('b', b'b' * 60, 'image/jpeg')
+    assert 'a' not in cache
+    assert 'b' in cache
+    assert cache.size() == 60
+
+
+def test_iiif_cache(tmp_path):
+    from dibs.caches import DiskCache, IIIFCache, MemoryCache
+
+    disk = DiskCache(str(tmp_path), 1000)
+    cache = IIIFCache(MemoryCache(1000), disk)
+    cache.put('a', b'abc', 'application/json')
+    assert disk.get('a') == (b'abc', 'application/json')
+    # A new memory cache picks up content from the shared disk cache.
+    other = IIIFCache(MemoryCache(1000), disk)
+    assert other.get('a') == (b'abc', 'application/json')
+
+
+def test_memory_cache():
+    from dibs.caches import MemoryCache
+
+    cache = MemoryCache(100)
+    cache.put('a', 'A', 40)
+    cache.put('b', 'B', 40)
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 40)
+    # 'b' was the least recently used entry.
+    assert 'b' not in cache
+    assert cache.size() == 80
+    # Entries bigger than the limit are not stored.
+    cache.put('d', 'D', 200)
+    assert 'd' not in cache
+
+
+def test_memory_cache_barcode_share():
+    from dibs.caches import MemoryCache
+
+    cache = MemoryCache(100, barcode_share = 0.5)
+    cache.put('a1', 'A1', 20, 'a')
+    cache.put('b1', 'B1', 20, 'b')
+    cache.put('b2', 'B2', 20, 'b')
+    cache.put('b3', 'B3', 20, 'b')
+    # Barcode 'b' can't take more than 50 bytes, so its oldest entry went.
+    assert 'b1' not in cache
+    assert 'a1' in cache
+    assert cache.get('b3') == 'B3'
+
+
+def test_single_flight():
+    from dibs.caches import SingleFlight
+    import threading
+    import time
+
+    flights = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(flights.do('k', slow)))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['result'] * 5
+    assert len(calls) == 1
+
+
+def test_single_flight_start():
+    from dibs.caches import SingleFlight
+    import threading
+
+    flights = SingleFlight()
+    finish = flights.start('k')
+    assert finish and 'k' in flights
+    assert flights.start('k') is None
+
+    # Callers of do(...) wait for the call that was started.
+    results = []
+    thread = threading.Thread(target = lambda: results.append(flights.do('k', lambda: 'x')))
+    thread.start()
+    finish('result')
+    thread.join()
+    assert results == ['result']
+    assert 'k' not in flights
+
+    # If the call is abandoned, the waiting callers make their own.
+    finish = flights.start('k')
+    thread = threading.Thread(target = lambda: results.append(flights.do('k', lambda: 'x')))
+    thread.start()
+    finish(abandoned = True)
+    finish('ignored')
+    thread.join()
+    assert results == ['result', 'x']
+
+
+def test_iiif_cache_load(tmp_path):
+    from dibs.caches import DiskCache, IIIFCache, MemoryCache
+
+    cache = IIIFCache(MemoryCache(1000), DiskCache(str(tmp_path), 1000))
+    assert cache.load('a', None, lambda: (b'abc', 'image/jpeg')) == (b'abc', 'image/jpeg')
+    assert cache.load('a', None, lambda: None) == (b'abc', 'image/jpeg')
+    assert cache.load('b', None, lambda: None) is None
+
+
+def test_manifest_cache(tmp_path):
+    from dibs.caches import ManifestCache
+    import os
+
+    calls = []
+
+    def transform(text, barcode):
+        calls.append(barcode)
+        return text.upper()
+
+    path = tmp_path / '123-manifest.json'
+    path.write_text('{"a": 1}')
+    cache = ManifestCache(1000, transform)
+    assert cache.get(str(path), '123')[0] == b'{"A": 1}'
+    assert cache.get(str(path), '123')[0] == b'{"A": 1}'
+    assert len(calls) == 1
+    path.write_text('{"b": 22}')
+    stat = path.stat()
+    os.utime(path, ns = (stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.get(str(path), '123')[0] == b'{"B": 22}'
+    assert len(calls) == 2
+    assert cache.get(str(tmp_path / 'missing.json'), '1') is None
+
+
+def test_manifest_cache_encoding(tmp_path):
+    from dibs.caches import ManifestCache
+    import gzip
+
+    path = tmp_path / '123-manifest.json'
+    path.write_text('{"a": 1}')
+    cache = ManifestCache(1000, lambda text, barcode: text)
+    content, stat = cache.get(str(path), '123', 'gzip')
+    assert gzip.decompress(content) == b'{"a": 1}'
+    assert cache.get(str(path), '123', 'gzip')[0] is content
+    assert cache.get(str(path), '123')[0] == b'{"a": 1}'
+
+
+def test_disk_cache_demote(tmp_path):
+    from dibs.caches import DiskCache
+
+    cache = DiskCache(str(tmp_path), 300)
+    cache.put('a1', b'a' * 100, 'image/jpeg', 'A')
+    cache.put('b1', b'b' * 100, 'image/jpeg', 'B')
+    cache.put('a2', b'c' * 100, 'image/jpeg', 'A')
+    cache.demote('B')
+    cache.put('a3', b'd' * 100, 'image/jpeg', 'A')
+    # The entry of the idle item is evicted, even though it's not the oldest.
+    assert 'b1' not in cache
+    assert all(key in cache for key in ['a1', 'a2', 'a3'])
+    cache.purge('A')
+    assert cache.size() == 0
+
+
+def test_memory_cache_purge():
+    from dibs.caches import MemoryCache
+
+    cache = MemoryCache(1000)
+    cache.put('a1', 'x', 10, 'A')
+    cache.put('a2', 'x', 10, 'A')
+    cache.put('b1', 'x', 10, 'B')
+    cache.purge('A')
+    assert len(cache) == 1 and 'b1' in cache
+    assert cache.size() == 10
+
+
+def test_iiif_cache_revalidate(tmp_path):
+    from dibs.caches import DiskCache, IIIFCache, MemoryCache
+    import time
+
+    disk = DiskCache(str(tmp_path), 1000)
+    cache = IIIFCache(MemoryCache(1000), disk, max_age = 60)
+    stale = []
+    cache.revalidate = lambda key, barcode: stale.append(key)
+    cache.put('a', b'old', 'image/jpeg', 'A')
+    assert cache.get('a') == (b'old', 'image/jpeg')
+    assert stale == []
+    cache.memory.put('a', (b'old', 'image/jpeg', time.time() - 120), 3, 'A')
+    assert cache.get('a') == (b'old', 'image/jpeg')
+    assert stale == ['a']
+    assert cache.refresh('a', 'A', lambda: None) is None
+    assert cache.get('a', memory_only = True) == (b'old', 'image/jpeg')
+    cache.refresh('a', 'A', lambda: (b'new', 'image/jpeg'))
+    assert cache.get('a') == (b'new', 'image/jpeg')
+    assert disk.entry('a')[2] > time.time() - 60
@@ -0,0 +1,22 @@
+import gzip
+
+
+def test_negotiated_encoding():
+    from dibs.compression import negotiated_encoding, ENCODINGS
+    assert negotiated_encoding(None) is None
+    assert negotiated_encoding('') is None
+    assert negotiated_encoding('identity') is None
+    assert negotiated_encoding('gzip') == 'gzip'
+    assert negotiated_encoding('deflate, gzip;q=0.5') == 'gzip'
+    assert negotiated_encoding('gzip;q=0') is None
+    assert negotiated_encoding('*') == ENCODINGS[0]
+    assert negotiated_encoding('*, gzip;q=0') == ('br' if 'br' in ENCODINGS else None)
+    assert negotiated_encoding('gzip, deflate, br') == ENCODINGS[0]
+
+
+def test_compressed():
+    from dibs.compression import compressed
+    content = b'{"id": "https://example.org/iiif/1"}' * 100
+    assert gzip.decompress(compressed(content, 'gzip')) == content
+    # The result must not depend on the time, so that entity tags are stable.
+    assert compressed(content, 'gzip') == compressed(content, 'gzip')
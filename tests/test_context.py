@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+from peewee import SqliteDatabase
+
+
+def test_request_context():
+    from dibs.context import RequestContext
+    from dibs.data_models import Counter, Item, Loan, Person, History
+    from dibs.people import _PERSON_CACHE
+    models = [Counter, Item, Loan, Person, History]
+    db = SqliteDatabase(':memory:')
+    with db.bind_ctx(models):
+        db.create_tables(models)
+        Person.create(uname = 'staff@x.edu', role = 'library', display_name = 'S')
+        Item.create(barcode = '123', item_id = '1', item_page = '', title = 'T',
+                    author = 'A', year = '2021', edition = '', publisher = '',
+                    num_copies = 1, duration = 1, ready = True, notes = '')
+        now = datetime.utcnow()
+        Loan.create(item = '123', state = 'active', user = 'patron@x.edu',
+                    start_time = now, end_time = now + timedelta(hours = 1),
+                    reloan_time = now + timedelta(hours = 2))
+
+        _PERSON_CACHE.clear()
+        context = RequestContext({'REMOTE_USER': 'staff@x.edu'})
+        assert context.person.uname == 'staff@x.edu'
+        assert context.staff
+        assert context.item('123').title == 'T'
+        assert context.item('999') is None
+        assert context.loan('123', 'patron@x.edu').state == 'active'
+        assert context.loan('123', 'other@x.edu') is None
+        assert context.loan('999', 'patron@x.edu') is None
+
+        # Values are looked up once and remembered until reload().
+        Loan.update(state = 'recent').execute()
+        Person.delete().execute()
+        assert context.loan('123', 'patron@x.edu').state == 'active'
+        assert context.staff
+        context.reload()
+        assert context.loan('123', 'patron@x.edu').state == 'recent'
+
+        guest = RequestContext({'REMOTE_USER': 'patron@x.edu'})
+        assert guest.person.uname == 'patron@x.edu'
+        assert not guest.staff
+        assert RequestContext({}).person is None
+        _PERSON_CACHE.clear()
@@ -0,0 +1,23 @@
+from peewee import OperationalError, SqliteDatabase
+import pytest
+
+
+def test_connection_settings(tmp_path, monkeypatch):
+    import dibs.data_models
+    from dibs.data_models import _pragmas, set_read_only, writable
+    db = SqliteDatabase(str(tmp_path / 'test.db'), autoconnect = False, pragmas = _pragmas)
+    monkeypatch.setattr(dibs.data_models, 'database', db)
+    db.connect()
+    assert db.pragma('journal_mode') == 'wal'
+    assert db.pragma('busy_timeout') == dict(_pragmas)['busy_timeout']
+    db.execute_sql('create table t (x)')
+
+    set_read_only(True)
+    with pytest.raises(OperationalError):
+        db.execute_sql('insert into t values (1)')
+    with writable():
+        db.execute_sql('insert into t values (1)')
+    assert db.pragma('query_only') == 1
+    set_read_only(False)
+    db.execute_sql('insert into t values (2)')
+    db.close()
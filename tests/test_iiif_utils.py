@@ -0,0 +1,113 @@
+def test_image_request_parts():
+    from dibs.iiif_utils import image_request_parts
+
+    url = 'https://example.edu/iiif/2/id/0,0,256,256/256,/0/default.jpg'
+    assert image_request_parts(url) == ('https://example.edu/iiif/2/id',
+                                        '0,0,256,256', '256,', '0', 'default.jpg')
+    assert image_request_parts('https://example.edu/iiif/2/id/info.json') is None
+
+
+def test_adjacent_tile_urls():
+    from dibs.iiif_utils import adjacent_tile_urls
+
+    info = {'width': 1000, 'height': 600,
+            'tiles': [{'width': 256, 'scaleFactors': [1, 2, 4]}]}
+    base = 'https://example.edu/iiif/2/id'
+    urls = adjacent_tile_urls(f'{base}/512,0,512,512/256,/0/default.jpg', info)
+    assert urls == [f'{base}/512,512,488,88/244,/0/default.jpg',
+                    f'{base}/0,0,512,512/256,/0/default.jpg']
+
+
+def test_services_in_manifest():
+    from dibs.iiif_utils import services_in_manifest
+
+    v2 = {'sequences': [{'canvases': [
+        {'images': [{'resource': {'service': {'@id': 'https://x.edu/iiif/2/p1'}}}]},
+        {'images': [{'resource': {'service': {'@id': 'https://x.edu/iiif/2/p2/'}}}]},
+    ]}]}
+    assert services_in_manifest(v2) == ['https://x.edu/iiif/2/p1',
+                                        'https://x.edu/iiif/2/p2']
+    v3 = {'items': [{'items': [{'items': [
+        {'body': {'service': [{'id': 'https://x.edu/iiif/3/p1'}]}}]}]}]}
+    assert services_in_manifest(v3) == ['https://x.edu/iiif/3/p1']
+
+
+def test_coarsest_tile_urls():
+    from dibs.iiif_utils import coarsest_tile_urls
+
+    base = 'https://example.edu/iiif/2/id'
+    info = {'width': 1000, 'height': 600,
+            'tiles': [{'width': 256, 'scaleFactors': [1, 2, 4]}]}
+    assert coarsest_tile_urls(base, info) == [f'{base}/full/250,/0/default.jpg']
+    info['tiles'][0]['scaleFactors'] = [1, 2]
+    assert coarsest_tile_urls(base, info) == [
+        f'{base}/0,0,512,512/256,/0/default.jpg',
+        f'{base}/512,0,488,512/244,/0/default.jpg',
+        f'{base}/0,512,512,88/256,/0/default.jpg',
+        f'{base}/512,512,488,88/244,/0/default.jpg']
+    info['@context'] = 'http://iiif.io/api/image/3/context.json'
+    info['tiles'][0]['scaleFactors'] = [1]
+    info['tiles'][0]['width'] = 2000
+    assert coarsest_tile_urls(base, info) == [f'{base}/full/max/0/default.jpg']
+    assert coarsest_tile_urls(base, {'width': 10, 'height': 10}) == []
+
+
+def test_pages_in_manifest():
+    from dibs.iiif_utils import pages_in_manifest
+
+    v2 = {'sequences': [{'canvases': [
+        {'thumbnail': {'@id': 'https://x.edu/iiif/2/p1/full/90,/0/default.jpg'},
+         'images': [{'resource': {'service': {'@id': 'https://x.edu/iiif/2/p1'}}}]},
+        {'images': [{'resource': {'service': {'@id': 'https://x.edu/iiif/2/p2'}}}]},
+    ]}]}
+    assert pages_in_manifest(v2) == [
+        ('https://x.edu/iiif/2/p1', 'https://x.edu/iiif/2/p1/full/90,/0/default.jpg'),
+        ('https://x.edu/iiif/2/p2', None)]
+
+
+def test_retiled_info():
+    from dibs.iiif_utils import retiled_info
+    info = {'@context': 'http://iiif.io/api/image/2/context.json',
+            'profile': ['http://iiif.io/api/image/2/level2.json'],
+            'width': 4000, 'height': 6000,
+            'tiles': [{'width': 256, 'scaleFactors': [1, 2, 4, 8, 16, 32]}]}
+    new = retiled_info(info, 1000)
+    assert new['tiles'] == [{'width': 768, 'scaleFactors': [1, 2, 4, 8]}]
+    assert info['tiles'][0]['width'] == 256
+    # Limits set by the image service are respected.
+    info['profile'].append({'maxWidth': 600})
+    assert retiled_info(info, 1024)['tiles'][0]['width'] == 512
+    # Level 0 services can't produce other tiles.
+    info['profile'] = 'http://iiif.io/api/image/2/level0.json'
+    assert retiled_info(info, 1024) is info
+    v3 = {'profile': 'level1', 'width': 1000, 'height': 800, 'maxArea': 600 * 600,
+          'tiles': [{'width': 200, 'height': 100, 'scaleFactors': [1, 2, 4]}]}
+    assert retiled_info(v3, 2000)['tiles'] == [{'width': 600, 'height': 300,
+                                               'scaleFactors': [1, 2, 4]}]
+    # Bad limits leave the info unchanged.
+    for max_area in [None, 'big', -1, [600]]:
+        bad = dict(v3, maxArea = max_area)
+        assert retiled_info(bad, 2000) is bad
+    assert retiled_info(dict(v3, maxArea = 360000.0), 2000)['tiles'][0]['width'] == 600
+
+
+def test_single_image_manifest():
+    from dibs.iiif_utils import single_image_manifest, services_in_manifest
+    service = 'https://iiif.x.edu/iiif/2/123%2Fp1'
+    manifest = {'sequences': [{'canvases': [
+        {'images': [{'resource': {'@id': service + '/full/full/0/default.jpg',
+                                  'width': 3000, 'height': 4000,
+                                  'service': {'@id': service}}}]},
+        {'images': [{'resource': {'@id': service + '2/full/full/0/default.jpg',
+                                  'width': 500, 'height': 800,
+                                  'service': {'@id': service + '2'}}}]}]}]}
+    new = single_image_manifest(manifest, 1000)
+    resources = [c['images'][0]['resource'] for c in new['sequences'][0]['canvases']]
+    assert resources[0] == {'@id': service + '/full/1000,/0/default.jpg',
+                            'width': 1000, 'height': 1333, 'format': 'image/jpeg'}
+    assert resources[1]['@id'] == service + '2/full/full/0/default.jpg'
+    assert services_in_manifest(new) == []
+    assert services_in_manifest(manifest) == [service, service + '2']
+    v3 = {'items': [{'items': [{'items': [{'body': {'id': 'x', 'service': [{'id': service}]}}]}]}]}
+    body = single_image_manifest(v3, 800)['items'][0]['items'][0]['items'][0]['body']
+    assert body == {'id': service + '/full/800,/0/default.jpg', 'format': 'image/jpeg'}
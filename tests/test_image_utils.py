@@ -0,0 +1,38 @@
+from io import BytesIO
+from PIL import Image
+
+
+def jpeg(width = 64, height = 48):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), (200, 100, 50)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_image_type():
+    from dibs.image_utils import image_type
+    assert image_type(jpeg()) == 'image/jpeg'
+    buffer = BytesIO()
+    Image.new('L', (8, 8)).save(buffer, 'PNG')
+    assert image_type(buffer.getvalue()) == 'image/png'
+    assert image_type(b'{"width": 100}') is None
+    assert image_type(b'') is None
+
+
+def test_negotiated_image_type():
+    from dibs.image_utils import negotiated_image_type
+    types = ['image/avif', 'image/webp']
+    chrome = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+    assert negotiated_image_type(chrome, types) == 'image/avif'
+    assert negotiated_image_type('image/webp,*/*', types) == 'image/webp'
+    assert negotiated_image_type('image/avif;q=0, image/webp', types) == 'image/webp'
+    assert negotiated_image_type('image/*, */*', types) is None
+    assert negotiated_image_type(None, types) is None
+
+
+def test_converted():
+    from dibs.image_utils import converted, conversion_types, image_type
+    assert 'image/webp' in conversion_types()
+    for ctype in conversion_types():
+        content = converted(jpeg(), ctype)
+        assert image_type(content) == ctype
+        assert Image.open(BytesIO(content)).size == (64, 48)
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+
+def test_loan_tokens(tmp_path):
+    from dibs.loan_tokens import LoanTokens
+    tokens = LoanTokens('secret', str(tmp_path / 'revoked'))
+    end = datetime.utcnow() + timedelta(hours = 1)
+    token = tokens.issue('someone@x.edu', '35047000', end)
+    assert tokens.verify(token, 'someone@x.edu', '35047000')
+    assert not tokens.verify(token, 'other@x.edu', '35047000')
+    assert not tokens.verify(token, 'someone@x.edu', '35047001')
+    assert not tokens.verify(token[:-1], 'someone@x.edu', '35047000')
+    assert not tokens.verify('', 'someone@x.edu', '35047000')
+    assert not tokens.verify(None, 'someone@x.edu', '35047000')
+    assert not LoanTokens('other', str(tmp_path)).verify(token, 'someone@x.edu', '35047000')
+    # Tokens can't be made to last longer.
+    later = str(int(token.split('.')[0]) + 3600) + '.' + token.split('.')[1]
+    assert not tokens.verify(later, 'someone@x.edu', '35047000')
+
+
+def test_loan_tokens_expire(tmp_path):
+    from dibs.loan_tokens import LoanTokens
+    tokens = LoanTokens('secret', str(tmp_path / 'revoked'))
+    end = datetime.utcnow() - timedelta(seconds = 1)
+    assert not tokens.verify(tokens.issue('someone@x.edu', '35047000', end),
+                             'someone@x.edu', '35047000')
+
+
+def test_loan_tokens_revoke(tmp_path):
+    from dibs.loan_tokens import LoanTokens
+    tokens = LoanTokens('secret', str(tmp_path / 'revoked'))
+    end = datetime.utcnow() + timedelta(hours = 1)
+    token = tokens.issue('someone@x.edu', '35047000', end)
+    other = tokens.issue('other@x.edu', '35047000', end)
+    tokens.revoke('someone@x.edu', '35047000', end)
+    assert not tokens.verify(token, 'someone@x.edu', '35047000')
+    assert tokens.verify(other, 'other@x.edu', '35047000')
+    # Revocations are seen by other instances (e.g., in other processes).
+    assert not LoanTokens('secret', str(tmp_path / 'revoked')).verify(
+        token, 'someone@x.edu', '35047000')
+    # A new loan of the same item has a different end time and a new token.
+    new_token = tokens.issue('someone@x.edu', '35047000', end + timedelta(hours = 2))
+    assert tokens.verify(new_token, 'someone@x.edu', '35047000')
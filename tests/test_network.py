@@ -0,0 +1,150 @@
+def test_backends_choose():
+    from dibs.network import Backends
+
+    backends = Backends('https://iiif.x.edu/iiif/2',
+                        ['https://a.x.edu/iiif/2', 'https://b.x.edu/iiif/2/'])
+    assert backends.urls == ['https://iiif.x.edu/iiif/2', 'https://a.x.edu/iiif/2',
+                             'https://b.x.edu/iiif/2']
+    assert (backends.url_for('https://iiif.x.edu/iiif/2/p1/info.json', 'https://b.x.edu/iiif/2')
+            == 'https://b.x.edu/iiif/2/p1/info.json')
+    main, a, b = backends.urls
+    backends.started(main)
+    backends.finished(main, 1.0, True)
+    backends.started(a)
+    backends.finished(a, 0.5, True)
+    backends.started(b)
+    backends.finished(b, 0.1, True)
+    assert backends.choose() == b
+    assert backends.choose(exclude = [b]) == a
+    assert backends.choose(exclude = [a, b]) == main
+    assert backends.choose(exclude = [main, a, b]) is None
+    # The fastest server is not chosen if it's much busier than the others.
+    for _ in range(10):
+        backends.started(b)
+    assert backends.choose() == a
+
+
+def test_backends_down():
+    from dibs.network import Backends
+
+    backends = Backends('https://a.x.edu', ['https://a.x.edu', 'https://b.x.edu'],
+                        max_errors = 2, down_time = 60)
+    a, b = backends.urls
+    for _ in range(2):
+        backends.started(a)
+        backends.finished(a, 0.01, False)
+    backends.started(b)
+    backends.finished(b, 5.0, True)
+    assert backends.choose() == b
+    # If every server is down, one is still returned.
+    for _ in range(2):
+        backends.started(b)
+        backends.finished(b, 0.01, False)
+    assert backends.choose() == a
+
+
+def test_backends_default():
+    from dibs.network import Backends
+
+    backends = Backends('https://a.x.edu/iiif/', [])
+    assert backends.urls == ['https://a.x.edu/iiif']
+    assert backends.choose() == 'https://a.x.edu/iiif'
+
+
+def test_backends_include_main_server():
+    from dibs.network import Backends
+
+    # The main server stays in the pool, so it's used if a mirror fails.
+    backends = Backends('https://a.x.edu/iiif', ['https://b.x.edu/iiif', 'https://a.x.edu/iiif/'])
+    assert backends.urls == ['https://a.x.edu/iiif', 'https://b.x.edu/iiif']
+    backends.started('https://b.x.edu/iiif')
+    backends.finished('https://b.x.edu/iiif', 0.01, False)
+    assert backends.choose(exclude = ['https://b.x.edu/iiif']) == 'https://a.x.edu/iiif'
+
+
+def test_latencies():
+    from dibs.network import Latencies
+
+    latencies = Latencies(size = 100, min_count = 10)
+    for elapsed in range(9):
+        latencies.add(elapsed)
+    assert latencies.percentile(95) is None
+    for elapsed in range(9, 200):
+        latencies.add(elapsed)
+    # Only the last 100 values are kept.
+    assert latencies.percentile(0) == 100
+    assert latencies.percentile(95) == 195
+    assert latencies.percentile(100) == 199
+
+
+def test_hedged():
+    from dibs.network import hedged
+    import time
+
+    delays = [0.5, 0]
+
+    def call():
+        delay = delays.pop(0)
+        time.sleep(delay)
+        return delay
+    start = time.monotonic()
+    assert hedged(call, 0.05, lambda result: True) == 0
+    assert time.monotonic() - start < 0.4
+    assert hedged(lambda: 'x', None, lambda result: True) == 'x'
+    # A result that is not ok is only used if there's nothing better.
+    delays = [0.2, 0]
+    assert hedged(call, 0.05, lambda result: result > 0) == 0.2
+
+    # Time spent waiting for a thread in the pool doesn't count as slow.
+    from dibs.network import _hedge_pool
+    from dibs.settings import config
+    import threading
+    release = threading.Event()
+    for _ in range(int(config('UPSTREAM_POOL_SIZE', default = 20))):
+        _hedge_pool().submit(release.wait)
+    threading.Timer(0.2, release.set).start()
+    calls = []
+    assert hedged(lambda: calls.append(1) or 'x', 0.05, lambda result: True) == 'x'
+    assert calls == [1]
+
+
+def test_hedged_slots():
+    from dibs.network import hedged
+    import threading
+    import time
+
+    # A slot is held until both calls finish, and no hedge is made without one.
+    slots = threading.BoundedSemaphore(1)
+    delays = [0.3, 0]
+    calls = []
+
+    def call():
+        calls.append(1)
+        delay = delays.pop(0) if delays else 0.3
+        time.sleep(delay)
+        return delay
+    assert hedged(call, 0.05, lambda result: True, slots) == 0
+    assert len(calls) == 2
+    assert hedged(call, 0.05, lambda result: True, slots) == 0.3
+    assert len(calls) == 3
+    time.sleep(0.1)
+    assert slots.acquire(blocking = False)
+
+
+def test_async_hedged():
+    from dibs.network import async_hedged
+    import asyncio
+
+    delays = [0.5, 0]
+    cancelled = []
+
+    async def call():
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+    assert asyncio.run(async_hedged(call, 0.05, lambda result: True)) == 0
+    assert cancelled == [0.5]
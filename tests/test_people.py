@@ -0,0 +1,33 @@
+from peewee import SqliteDatabase
+import time
+
+
+def test_person_cache():
+    from dibs.data_models import Counter, Person
+    from dibs.people import PersonCache, people_changed
+    models = [Counter, Person]
+    db = SqliteDatabase(':memory:')
+    with db.bind_ctx(models):
+        db.create_tables(models)
+        Person.create(uname = 'staff@x.edu', role = 'library', display_name = 'S')
+        cache = PersonCache(300, check_interval = 0)
+        assert cache.get('staff@x.edu').role == 'library'
+        assert cache.get('patron@x.edu') is None
+
+        # Changes are not seen until the people counter is incremented.
+        Person.update(role = '').execute()
+        Person.create(uname = 'patron@x.edu', role = 'library', display_name = 'P')
+        assert cache.get('staff@x.edu').role == 'library'
+        assert cache.get('patron@x.edu') is None
+        people_changed()
+        assert cache.get('staff@x.edu').role == ''
+        assert cache.get('patron@x.edu').role == 'library'
+        people_changed()
+        assert Counter.get(Counter.name == 'people').value == 2
+
+        # Entries expire on their own, too.
+        cache = PersonCache(0.001, check_interval = 300)
+        assert cache.get('staff@x.edu').role == ''
+        Person.update(role = 'library').execute()
+        time.sleep(0.01)
+        assert cache.get('staff@x.edu').role == 'library'
@@ -0,0 +1,12 @@
+def test_pid_local_pool():
+    from dibs.prefetch import pid_local_pool
+    import dibs.prefetch
+
+    pool = pid_local_pool('test', 2)
+    assert pid_local_pool('test', 2) is pool
+    assert pid_local_pool('other test', 2) is not pool
+    assert pool.submit(lambda: 'x').result() == 'x'
+    # In a forked process, the pool is replaced by a new one.
+    pid, executor = dibs.prefetch._pools['test']
+    dibs.prefetch._pools['test'] = (pid + 1, executor)
+    assert pid_local_pool('test', 2) is not pool
@@ -0,0 +1,35 @@
+import time
+
+
+def test_reaper(tmp_path):
+    from dibs.reaper import Reaper
+    calls = []
+    due_file = str(tmp_path / 'due')
+
+    def reap():
+        calls.append(time.time())
+        return time.time() + 100
+
+    reaper = Reaper(due_file, reap, max_wait = 1000)
+    reaper.run_if_due()
+    assert len(calls) == 1
+    assert 99 < reaper.due() - time.time() <= 100
+    # Nothing happens until the due time.
+    reaper.run_if_due()
+    assert len(calls) == 1
+    # Other instances (e.g., in other processes) share the due time.
+    other = Reaper(due_file, reap, max_wait = 1000)
+    other.schedule(time.time() - 1)
+    reaper.run_if_due()
+    assert len(calls) == 2
+    # Scheduling a later time does not postpone the due time.
+    reaper.schedule(time.time() + 500)
+    assert reaper.due() - time.time() <= 100
+
+
+def test_reaper_max_wait(tmp_path):
+    from dibs.reaper import Reaper
+    reaper = Reaper(str(tmp_path / 'due'), lambda: None, max_wait = 10)
+    assert reaper.due() == 0
+    reaper.run_if_due()
+    assert 9 < reaper.due() - time.time() <= 10
@@ -0,0 +1,218 @@
+from   datetime import timedelta
+from   peewee import SqliteDatabase
+import pytest
+
+
+@pytest.fixture
+def loans_db(monkeypatch):
+    import dibs.data_models
+    import dibs.people
+    import dibs.server
+    from dibs.data_models import Counter, History, Item, Loan, Person
+    models = [Counter, History, Item, Loan, Person]
+    db = SqliteDatabase(':memory:')
+    monkeypatch.setattr(dibs.data_models, 'database', db)
+    monkeypatch.setattr(dibs.server, 'database', db)
+    dibs.people._PERSON_CACHE.clear()
+    with db.bind_ctx(models):
+        db.create_tables(models)
+        Person.create(uname = 'staff@x.edu', role = 'library', display_name = 'S')
+        for barcode in ['1', '2', '3', '4']:
+            Item.create(barcode = barcode, item_id = barcode, item_page = '', title = '',
+                        author = '', year = '', edition = '', publisher = '',
+                        num_copies = 1, duration = 1, notes = '')
+        yield db
+    dibs.people._PERSON_CACHE.clear()
+
+
+def old_expire_loans(loans, now, wait, debug):
+    # What expire_loans() did when it updated one loan at a time.
+    from dibs.date_utils import round_minutes
+    expected, history = {}, []
+    for barcode, uname, state, start, end, reloan in loans:
+        if state == 'recent' and now >= reloan:
+            continue
+        if state == 'active' and now >= end:
+            state, reloan = 'recent', round_minutes(end + wait, 'down')
+            if debug or uname != 'staff@x.edu':
+                history.append(('loan', barcode, start, end))
+        expected[(barcode, uname)] = (state, reloan)
+    return expected, sorted(history)
+
+
+@pytest.mark.parametrize('debug', [False, True])
+def test_expire_loans(loans_db, monkeypatch, debug):
+    import dibs.server
+    from dibs.data_models import History, Loan
+    from dibs.date_utils import time_now, timestamp
+    from dibs.server import _RELOAN_WAIT_TIME, expire_loans
+
+    monkeypatch.setattr(dibs.server.dibs, 'debug_mode', debug, raising = False)
+    now = time_now()
+
+    def minutes(n):
+        return timedelta(minutes = n, seconds = 17)
+    loans = [
+        # Active loans that have ended, by a patron and a staff user.
+        ('1', 'patron@x.edu', 'active', now - minutes(90), now - minutes(30), now),
+        ('2', 'staff@x.edu', 'active', now - minutes(70), now - minutes(10), now),
+        # An active loan that hasn't ended yet.
+        ('3', 'patron@x.edu', 'active', now - minutes(5), now + minutes(55), now),
+        # Recent loans that have and haven't reached their reloan times.
+        ('4', 'patron@x.edu', 'recent', now - minutes(90), now - minutes(60), now),
+        ('4', 'other@x.edu', 'recent', now - minutes(90), now - minutes(60), now + minutes(3)),
+    ]
+    for barcode, uname, state, start, end, reloan in loans:
+        Loan.create(item = barcode, user = uname, state = state, start_time = start,
+                    end_time = end, reloan_time = reloan)
+    expected, history = old_expire_loans(loans, now, _RELOAN_WAIT_TIME, debug)
+
+    next_time = expire_loans()
+    assert {(loan.barcode, loan.user): (loan.state, loan.reloan_time)
+            for loan in Loan.select()} == expected
+    assert sorted((h.type, h.what, h.start_time, h.end_time)
+                  for h in History.select()) == history
+    assert len(history) == (2 if debug else 1)
+    # The next update is due when loan 3 ends or a recent loan can be removed.
+    reloans = [reloan for state, reloan in expected.values() if state == 'recent']
+    assert next_time == timestamp(min(reloans + [now + minutes(55)]))
+
+
+@pytest.fixture
+def iiif_urls(monkeypatch):
+    import dibs.server
+    from dibs.network import Backends
+    base = 'https://iiif.x.edu/iiif/2'
+    monkeypatch.setattr(dibs.server, '_IIIF_BASE_URL', base)
+    monkeypatch.setattr(dibs.server, '_IIIF_BACKENDS', Backends(base, ['https://m.x.edu/iiif/2']))
+    monkeypatch.setattr(dibs.server.dibs, 'base_url', 'https://dibs.x.edu', raising = False)
+
+
+def test_urls_rerouted_stream(iiif_urls):
+    from dibs.server import urls_rerouted, urls_rerouted_stream
+
+    text = ('{"@id": "https://iiif.x.edu/iiif/2/35047%2Fp1", "x": "é", '
+            '"service": "https://m.x.edu/iiif/2/35047%2Fp2/info.json", "n": 1}')
+    expected = urls_rerouted(text, '35047')
+    assert 'https://dibs.x.edu/iiif/35047/35047!p1' in expected
+    assert 'https://dibs.x.edu/iiif/35047/35047!p2/info.json' in expected
+    data = text.encode()
+    # Split the text everywhere, including inside URLs and UTF-8 characters.
+    for size in [1, 2, 3, 7, 20, len(data)]:
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert b''.join(urls_rerouted_stream(chunks, '35047')).decode() == expected
+    for cut in range(len(data)):
+        chunks = [data[:cut], data[cut:]]
+        assert b''.join(urls_rerouted_stream(chunks, '35047')).decode() == expected
+
+
+def test_urls_rerouted_stream_without_quotes(iiif_urls, monkeypatch):
+    import dibs.server
+    from dibs.server import urls_rerouted_stream
+
+    # Text without double quotes is passed on once there is enough of it.
+    monkeypatch.setattr(dibs.server, '_MAX_PENDING_TEXT', 64)
+    data = (b'x' * 60 + b'https://iiif.x.edu/iiif/2/35047%2Fp1 ') * 4
+    chunks = [data[i:i + 50] for i in range(0, len(data), 50)]
+    output = list(urls_rerouted_stream(chunks, '35047'))
+    assert len(output) > 1
+    assert b''.join(output) == (b'x' * 60 + b'https://dibs.x.edu/iiif/35047/35047!p1 ') * 4
+
+
+@pytest.fixture
+def environ():
+    from bottle import request
+    environ = {'REQUEST_METHOD': 'GET'}
+    request.bind(environ)
+    yield environ
+    request.bind({})
+
+
+def test_partial_content():
+    from dibs.server import partial_content
+
+    content = b'0123456789'
+    result = partial_content(content, 'image/jpeg', 'bytes=2-4')
+    assert result.status_code == 206
+    assert result.body == b'234'
+    assert result.headers['Content-Range'] == 'bytes 2-4/10'
+    assert result.headers['Content-Length'] == '3'
+    # Suffix and open-ended ranges.
+    result = partial_content(content, 'image/jpeg', 'bytes=-3')
+    assert (result.status_code, result.body) == (206, b'789')
+    assert result.headers['Content-Range'] == 'bytes 7-9/10'
+    result = partial_content(content, 'image/jpeg', 'bytes=6-')
+    assert (result.status_code, result.body) == (206, b'6789')
+    # A range past the end can't be satisfied.
+    result = partial_content(content, 'image/jpeg', 'bytes=10-')
+    assert result.status_code == 416
+    assert result.headers['Content-Range'] == 'bytes */10'
+    # More than one range gets the whole content.
+    result = partial_content(content, 'image/jpeg', 'bytes=0-1,5-6')
+    assert (result.status_code, result.body) == (200, content)
+    assert result.headers['Content-Length'] == '10'
+    result = partial_content(content, 'image/jpeg')
+    assert (result.status_code, result.body) == (200, content)
+
+
+def test_range_requested(environ):
+    from dibs.server import range_requested
+    from email.utils import formatdate
+
+    etag = '"abc"'
+    assert range_requested(etag) is None
+    environ['HTTP_RANGE'] = 'bytes=0-9'
+    assert range_requested(etag) == 'bytes=0-9'
+    environ['HTTP_IF_RANGE'] = '"abc"'
+    assert range_requested(etag) == 'bytes=0-9'
+    # If the client's copy is stale, the whole content is sent instead.
+    environ['HTTP_IF_RANGE'] = '"old"'
+    assert range_requested(etag) is None
+    # Weak entity tags never match in If-Range.
+    environ['HTTP_IF_RANGE'] = 'W/"abc"'
+    assert range_requested(etag) is None
+    environ['HTTP_IF_RANGE'] = formatdate(1600000000, usegmt = True)
+    assert range_requested(etag, 1600000000.5) == 'bytes=0-9'
+    assert range_requested(etag, 1600000100) is None
+
+
+def test_send_content_if_range(environ):
+    from dibs.server import content_etag, send_content
+
+    content = b'0123456789'
+    environ['HTTP_RANGE'] = 'bytes=0-1'
+    environ['HTTP_IF_RANGE'] = content_etag(content)
+    assert send_content(content, 'image/jpeg').status_code == 206
+    environ['HTTP_IF_RANGE'] = content_etag(b'older content')
+    result = send_content(content, 'image/jpeg')
+    assert (result.status_code, result.body) == (200, content)
+
+
+def test_etag_matches():
+    from dibs.server import etag_matches
+
+    # If-None-Match uses the weak comparison, so W/ is ignored.
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches('*', '"abc"')
+    assert not etag_matches('"abcd"', '"abc"')
+    assert not etag_matches('"x", "y"', '"abc"')
+
+
+def test_client_copy_current(environ):
+    from dibs.server import client_copy_current, content_etag, send_content
+    from email.utils import formatdate
+
+    content = b'0123456789'
+    etag = content_etag(content)
+    assert not client_copy_current(etag, 1600000000)
+    environ['HTTP_IF_MODIFIED_SINCE'] = formatdate(1600000000, usegmt = True)
+    assert client_copy_current(etag, 1600000000)
+    assert not client_copy_current(etag, 1600000100)
+    # If-None-Match takes precedence over If-Modified-Since.
+    environ['HTTP_IF_NONE_MATCH'] = '"old"'
+    assert not client_copy_current(etag, 1600000000)
+    environ['HTTP_IF_NONE_MATCH'] = 'W/' + etag
+    assert client_copy_current(etag, 1600000000)
+    assert send_content(content, 'image/jpeg').status_code == 304